@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for md-tw.
+
+The lex phase, the render phase and whole documents are timed
+separately, on Markdown files or on a synthetic corpus.
+"""
+
+import argparse
+import json
+import random
+import time
+
+import mistune
+
+from markdown_textwrap._version import __version__
+
+
+_words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua ut '
+          'enim ad minim veniam quis nostrud exercitation ullamco laboris '
+          'nisi aliquip ex ea commodo consequat duis aute irure in '
+          'reprehenderit voluptate velit esse cillum eu fugiat nulla '
+          'pariatur').split()
+
+# Phases timed by bench.
+phases = ('lex', 'render', 'total')
+
+
+def _sentence(rng, n):
+    return ' '.join(rng.choice(_words) for i in range(n)).capitalize() + '.'
+
+
+def _paragraph(rng, n):
+    return ' '.join(_sentence(rng, rng.randint(4, 16)) for i in range(n))
+
+
+def _list(rng, depth, indent=''):
+    items = []
+    for i in range(rng.randint(2, 4)):
+        items.append('{}- {}\n'.format(indent, _paragraph(rng, 2)))
+    if depth > 1:
+        items.append(_list(rng, depth - 1, indent + '  '))
+
+    return ''.join(items)
+
+
+def _block_quote(rng, depth):
+    prefix = '> ' * depth
+
+    return '{}{}\n{}\n{}{}\n'.format(prefix, _paragraph(rng, 3),
+                                     prefix.rstrip(), prefix,
+                                     _paragraph(rng, 2))
+
+
+def gen_doc(rng, blocks=40):
+    """Generate a Markdown document of about blocks top-level blocks.
+
+    The document has long paragraphs, deeply nested lists, nested
+    block quotes, and footnotes and def links.
+    """
+    doc = []
+    notes = []
+    for i in range(blocks):
+        kind = rng.randrange(5)
+        if kind == 0:
+            doc.append('{}\n'.format(_paragraph(rng, rng.randint(8, 20))))
+        elif kind == 1:
+            doc.append(_list(rng, rng.randint(2, 5)))
+        elif kind == 2:
+            doc.append(_block_quote(rng, rng.randint(1, 4)))
+        elif kind == 3:
+            key = len(notes) + 1
+            notes.append('[^{}]: {}\n'.format(key, _paragraph(rng, 3)))
+            doc.append('{}[^{}] {}\n'.format(_paragraph(rng, 2), key,
+                                             _paragraph(rng, 2)))
+        else:
+            key = 'link-{}'.format(i)
+            notes.append('[{}]: http://example.com/{} "{}"\n'.format(
+                key, i, _sentence(rng, 3)))
+            doc.append('{} [{}][{}] {}\n'.format(_paragraph(rng, 2),
+                                                 rng.choice(_words), key,
+                                                 _paragraph(rng, 1)))
+
+    return '\n'.join(doc + notes)
+
+
+def gen_corpus(docs=50, blocks=40, seed=0):
+    """Generate docs synthetic Markdown documents; see gen_doc.
+    """
+    rng = random.Random(seed)
+
+    return [gen_doc(rng, blocks) for i in range(docs)]
+
+
+def _time(func, docs, repeat, reset):
+    """Best time of repeat runs of func over docs.
+
+    reset is called before each run.
+    """
+    best = None
+    for i in range(repeat):
+        reset()
+        start = time.perf_counter()
+        for doc in docs:
+            func(doc)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def bench(docs, repeat=3, **kwargs):
+    """Time md-tw over docs, a list of Markdown documents.
+
+    TWMarkdown is created with kwargs.  The lex phase
+    (TWBlockLexer.parse), the render phase and whole documents
+    (TWMarkdown.__call__) are timed separately.  Returns a dict that
+    maps each phase to a dict with its best 'seconds' of repeat runs,
+    'docs_per_s' and 'mb_per_s'.
+    """
+    from md_tw import TWMarkdown
+
+    md = TWMarkdown(**kwargs)
+    texts = [mistune.preprocessing(doc) for doc in docs]
+
+    def lex(text):
+        md.block.tokens = []
+        try:
+            return md.block(text)
+        finally:
+            # reset block
+            md.block.def_links = {}
+            md.block.def_footnotes = {}
+
+    def render(tokens):
+        md.inline.setup({}, {})
+        return md._render(list(tokens))
+
+    def reset():
+        # Runs don't get the fills cached by earlier runs.
+        md.renderer._tw_fill_cached.cache_clear()
+
+    streams = [lex(text) for text in texts]
+    size = sum(len(doc.encode('utf-8', 'surrogateescape')) for doc in docs)
+
+    results = {}
+    for phase, func, args in (('lex', lex, texts),
+                              ('render', render, streams),
+                              ('total', md, docs)):
+        seconds = _time(func, args, repeat, reset)
+
+        results[phase] = {
+            'seconds': seconds,
+            'docs_per_s': len(docs) / seconds if seconds else 0.0,
+            'mb_per_s': size / 1e6 / seconds if seconds else 0.0,
+        }
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare results of bench with baseline results.
+
+    Yields (phase, change, regressed) for the phases in both; change
+    is the relative change in docs/s and a phase has regressed when it
+    is slower than baseline by more than tolerance.
+    """
+    for phase in phases:
+        if phase not in results or phase not in baseline:
+            continue
+
+        old = baseline[phase]['docs_per_s']
+        change = results[phase]['docs_per_s'] / old - 1 if old else 0.0
+
+        yield phase, change, change < -tolerance
+
+
+def _load_docs(paths):
+    from md_tw import _iter_md_files
+
+    docs = []
+    for path in _iter_md_files(paths):
+        with open(path) as f:
+            docs.append(f.read())
+
+    return docs
+
+
+def main(argv=None):
+    """Run `md-tw bench`; returns the exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog='md-tw bench',
+        description='Time md-tw on Markdown files or, without paths, on '
+                    'a synthetic corpus.'
+    )
+    parser.add_argument('-w', '--width', type=int, default=72,
+                        help='Max. line width.  Default is 72.')
+    parser.add_argument('-m', '--mode', default='greedy',
+                        choices=['greedy', 'optimal'],
+                        help='Fill mode.  Default is greedy.')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Runs per phase; the best is kept.  '
+                             'Default is 3.')
+    parser.add_argument('--docs', type=int, default=50,
+                        help='Number of documents in the synthetic '
+                             'corpus.  Default is 50.')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save the results as a baseline to FILE.')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare with the baseline saved in FILE; '
+                             'exit with status 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Slowdown allowed before a phase counts as '
+                             'a regression.  Default is 0.1 (10%%).')
+    parser.add_argument('path', nargs='*',
+                        help='Markdown file or directory of Markdown '
+                             'files.')
+    a = parser.parse_args(argv)
+
+    if a.path:
+        docs = _load_docs(a.path)
+    else:
+        docs = gen_corpus(a.docs)
+
+    results = bench(docs, a.repeat, tw_width=a.width, tw_mode=a.mode)
+
+    baseline = None
+    if a.baseline:
+        with open(a.baseline) as f:
+            baseline = json.load(f)['results']
+
+    size = sum(len(doc.encode('utf-8', 'surrogateescape')) for doc in docs)
+    print('{} docs, {:.2f} MB'.format(len(docs), size / 1e6))
+
+    status = 0
+    changes = dict((p, (c, r)) for p, c, r in
+                   compare(results, baseline or {}, a.tolerance))
+    for phase in phases:
+        r = results[phase]
+        line = '{:<8}{:>10.1f} docs/s{:>10.2f} MB/s'.format(
+            phase, r['docs_per_s'], r['mb_per_s'])
+
+        if phase in changes:
+            change, regressed = changes[phase]
+            line += '{:>+9.1%}'.format(change)
+            if regressed:
+                line += '  regression'
+                status = 1
+        print(line)
+
+    if a.save:
+        with open(a.save, 'w') as f:
+            json.dump({'version': __version__, 'docs': len(docs),
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    return status
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""
+Columns text takes up on a terminal.
+
+East Asian wide and fullwidth characters take two columns; combining
+marks, format characters and Hangul medial vowels and final consonants
+take none; other characters take one.  Widths are looked up in a
+table of the Basic Multilingual Plane made from the ranges of
+_column_table, which is generated from unicodedata with `make
+column-table`, so that unicodedata is not needed at run time.
+"""
+
+import bisect
+import functools
+import os
+import re
+
+
+# Characters below this code point all take one column.
+_first_special = '\u0300'
+
+
+@functools.lru_cache(maxsize=None)
+def _astral_pattern():
+    """Characters beyond the Basic Multilingual Plane."""
+    return re.compile('[\U00010000-\U0010ffff]')
+
+
+@functools.lru_cache(maxsize=None)
+def _bmp_table():
+    """Columns of the characters of the Basic Multilingual Plane, by
+    code point.
+    """
+    from markdown_textwrap import _column_table as table
+
+    bmp = bytearray(0x10000)
+    ends = table.starts[1:] + (0x110000,)
+    for start, end, width in zip(table.starts, ends, table.widths):
+        end = min(end, 0x10000)
+        if start < end:
+            bmp[start:end] = bytes([width]) * (end - start)
+
+    return bytes(bmp)
+
+
+def width(text):
+    """Columns text takes up."""
+    # ASCII characters take a column each.
+    if text.isascii():
+        return len(text)
+
+    # Characters of the BMP are replaced by the character whose code
+    # point is their width; others are left as they are.
+    cols = text.translate(_bmp_table())
+    n = len(cols) + cols.count('\x02') - cols.count('\x00')
+    for c in _astral_pattern().findall(text):
+        n += char_width(c) - 1
+
+    return n
+
+
+def char_width(c):
+    """Columns the character c takes up: 0, 1 or 2."""
+    if c < _first_special:
+        return 1
+
+    cp = ord(c)
+    if cp < 0x10000:
+        return _bmp_table()[cp]
+
+    from markdown_textwrap import _column_table as table
+
+    return table.widths[bisect.bisect_right(table.starts, cp) - 1]
+
+
+def fit(text, columns):
+    """Number of characters at the start of text that fit in columns;
+    characters that take no columns go with the character before them.
+    """
+    n = 0
+    for c in text:
+        columns -= char_width(c)
+        if columns < 0:
+            break
+        n += 1
+
+    return n
+
+
+# Code points, assigned or not, that are wide by default.
+_cjk_ranges = [(0x3400, 0x4dbf), (0x4e00, 0x9fff), (0xf900, 0xfaff),
+               (0x20000, 0x2fffd), (0x30000, 0x3fffd)]
+
+
+def _char_width(cp):
+    """Columns of the code point cp, from unicodedata."""
+    import unicodedata
+
+    c = chr(cp)
+    category = unicodedata.category(c)
+    if (category in ('Mn', 'Me')
+            or (category == 'Cf' and c != '\xad')
+            or 0x1160 <= cp <= 0x11ff):
+        return 0
+    if category == 'Cn':
+        # Unassigned code points are wide in the blocks and planes set
+        # aside for CJK ideographs; unicodedata has them all wide.
+        return 2 if any(s <= cp <= e for s, e in _cjk_ranges) else 1
+    if unicodedata.east_asian_width(c) in ('W', 'F'):
+        return 2
+    return 1
+
+
+def _table_source():
+    import unicodedata
+
+    starts = []
+    widths = []
+    for cp in range(0x110000):
+        w = _char_width(cp)
+        if not widths or widths[-1] != w:
+            starts.append(cp)
+            widths.append(w)
+
+    def items(values, fmt, per_line):
+        values = [fmt.format(v) for v in values]
+        return '\n'.join('    {},'.format(', '.join(values[i:i + per_line]))
+                         for i in range(0, len(values), per_line))
+
+    return '\n'.join([
+        '# Generated by `make column-table` from unicodedata {}; do not '
+        'edit.'.format(unicodedata.unidata_version),
+        '',
+        '# Starts of ranges of code points, and the columns each code '
+        'point',
+        '# in a range takes up.',
+        'starts = (',
+        items(starts, '0x{:05x}', 8),
+        ')',
+        'widths = (',
+        items(widths, '{}', 24),
+        ')',
+        '',
+    ])
+
+
+def write_table():
+    """Generate _column_table from unicodedata.
+    """
+    path = os.path.join(os.path.dirname(__file__), '_column_table.py')
+    with open(path, 'w') as f:
+        f.write(_table_source())
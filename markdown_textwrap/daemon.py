@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""
+md-tw daemon and client.
+
+The daemon keeps TWMarkdown instances warm behind a Unix socket; the
+client sends it documents to wrap.  Run as md-tw-client, the client
+does not import mistune or md_tw unless it has to wrap documents
+itself, when no daemon is running; md-tw --client imports them with
+md_tw.
+
+A request is a line of JSON with the TWMarkdown 'options' and the
+'size' of the document in bytes, followed by the UTF-8 encoded
+document.  A response is a line of JSON with the 'size' of the
+wrapped document, or an 'error', followed by the wrapped document.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+
+# Options a client may ask for, and their types.
+_options = {'tw_width': int, 'tw_mode': str}
+
+# Longest request header read, in bytes.
+_max_header = 4096
+
+# TWMarkdown instances kept warm, one for each set of options.
+_max_instances = 16
+
+
+class DaemonError(Exception):
+    """Error reported by the daemon, or starting it."""
+
+
+def socket_path():
+    """Default path of the daemon's socket.
+    """
+    run_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+
+    return os.path.join(run_dir, 'md-tw-{}.sock'.format(os.getuid()))
+
+
+def _read_header(f):
+    line = f.readline(_max_header + 1)
+    if not line.endswith(b'\n'):
+        raise DaemonError('bad header')
+
+    return json.loads(line.decode('utf-8'))
+
+
+def _write(f, header, data=b''):
+    f.write(json.dumps(header).encode('utf-8') + b'\n')
+    f.write(data)
+    f.flush()
+
+
+def _remove_stale_socket(path):
+    """Remove the socket at path if no daemon listens on it.
+
+    Raises DaemonError if something else is at path, or a daemon
+    listens on it.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise DaemonError('{} is not a socket'.format(path))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            # Left by a daemon that is gone.
+            os.unlink(path)
+            return
+
+    raise DaemonError('a daemon is running at {}'.format(path))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.slots:
+            server.begin()
+            try:
+                self._handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client hung up; a daemon starting checks if one
+                # is running that way.
+                pass
+            finally:
+                server.end()
+
+    def _handle(self):
+        server = self.server
+        try:
+            header = _read_header(self.rfile)
+            size = header['size']
+            options = dict((k, _options[k](v))
+                           for k, v in header.get('options', {}).items()
+                           if k in _options)
+        except (DaemonError, KeyError, TypeError, ValueError):
+            _write(self.wfile, {'error': 'bad request'})
+            return
+
+        if not isinstance(size, int) or size < 0:
+            _write(self.wfile, {'error': 'bad request'})
+            return
+        if size > server.max_size:
+            # The document is read all the same, so that the client,
+            # which sends it before it reads the response, gets the
+            # error however large the document is.
+            while size:
+                data = self.rfile.read(min(size, 1 << 16))
+                if not data:
+                    return
+                size -= len(data)
+            _write(self.wfile, {'error': 'document is larger than {} bytes'
+                                         .format(server.max_size)})
+            return
+
+        data = self.rfile.read(size)
+        if len(data) != size:
+            return
+
+        try:
+            text = data.decode('utf-8', 'surrogateescape')
+            wrapped = server.wrap(text, options)
+        except Exception as e:
+            _write(self.wfile, {'error': str(e)})
+            return
+
+        data = wrapped.encode('utf-8', 'surrogateescape')
+        _write(self.wfile, {'size': len(data)}, data)
+
+
+class TWDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Wrap documents sent over a Unix socket.
+
+    At most max_clients documents are wrapped at a time; others wait.
+    Documents larger than max_size bytes are refused.  serve returns
+    once no request has come for idle_timeout seconds.
+
+    Raises DaemonError if something other than a socket left by a
+    daemon that is gone is at path.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, max_clients=4, max_size=16 << 20,
+                 idle_timeout=600):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_clients)
+
+        # TWMarkdown instances, by their options, least recently used
+        # first; threads share them.
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last = time.monotonic()
+
+        _remove_stale_socket(path)
+
+        umask = os.umask(0o077)
+        try:
+            super(TWDaemon, self).__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def begin(self):
+        with self._lock:
+            self._active += 1
+
+    def end(self):
+        with self._lock:
+            self._active -= 1
+            self._last = time.monotonic()
+
+    def idle(self):
+        with self._lock:
+            return (not self._active
+                    and time.monotonic() - self._last >= self.idle_timeout)
+
+    def wrap(self, text, options):
+        from md_tw import TWMarkdown
+
+        key = tuple(sorted(options.items()))
+        with self._lock:
+            md = self._instances.pop(key, None)
+            if md is None:
+                md = TWMarkdown(**options)
+            self._instances[key] = md
+            if len(self._instances) > _max_instances:
+                del self._instances[next(iter(self._instances))]
+
+        return md(text)
+
+    def serve(self):
+        """Serve requests until the daemon is idle for idle_timeout
+        seconds.
+        """
+        self.timeout = min(self.idle_timeout, 1.0)
+        try:
+            while not self.idle():
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.unlink(self.server_address)
+
+
+def request(text, options, path=None):
+    """Wrap text with the daemon listening at path.
+
+    options are TWMarkdown options.  Raises OSError if there is no
+    daemon, DaemonError if the daemon could not wrap text, or the
+    connection to it was lost.
+    """
+    data = text.encode('utf-8', 'surrogateescape')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path or socket_path())
+        try:
+            with sock.makefile('rwb') as f:
+                _write(f, {'options': options, 'size': len(data)}, data)
+
+                header = _read_header(f)
+                if 'error' in header:
+                    raise DaemonError(header['error'])
+
+                data = f.read(header['size'])
+        except OSError as e:
+            raise DaemonError(e.strerror or str(e))
+
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def _parser(prog, description):
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument('--socket', default=socket_path(),
+                        help='Path of the daemon\'s socket.  Default is '
+                             '{}.'.format(socket_path()))
+
+    return parser
+
+
+def daemon_main(argv=None):
+    """Run `md-tw --daemon`; returns the exit status.
+    """
+    parser = _parser('md-tw --daemon',
+                     'Keep md-tw running, wrapping documents sent by '
+                     'md-tw --client.')
+    parser.add_argument('--max-clients', type=int, default=4,
+                        help='Documents wrapped at a time.  Default is 4.')
+    parser.add_argument('--max-size', type=int, default=16 << 20,
+                        help='Largest document wrapped, in bytes.  '
+                             'Default is 16 MiB.')
+    parser.add_argument('--idle-timeout', type=float, default=600,
+                        help='Seconds without requests after which the '
+                             'daemon exits.  Default is 600.')
+    a = parser.parse_args(argv)
+
+    try:
+        server = TWDaemon(a.socket, a.max_clients, a.max_size,
+                          a.idle_timeout)
+    except (DaemonError, OSError) as e:
+        print('md-tw: {}'.format(e), file=sys.stderr)
+        return 1
+    server.serve()
+
+    return 0
+
+
+def client_main(argv=None):
+    """Run `md-tw-client`, or `md-tw --client`; returns the exit
+    status.
+
+    Documents are wrapped here if no daemon is running.
+    """
+    parser = _parser('md-tw-client',
+                     'Wrap Markdown documents with md-tw --daemon.')
+    parser.add_argument('-w', '--width', type=int, default=72,
+                        help='Max. line width.  Default is 72.')
+    parser.add_argument('-m', '--mode', default='greedy',
+                        choices=['greedy', 'optimal'],
+                        help='Fill mode.  Default is greedy.')
+    parser.add_argument('md_file', nargs='*', default=['-'],
+                        help='File path of Markdown document; - or no '
+                             'path reads from stdin.')
+    a = parser.parse_args(argv)
+    options = {'tw_width': a.width, 'tw_mode': a.mode}
+
+    status = 0
+    for md_file in a.md_file:
+        try:
+            if md_file == '-':
+                text = sys.stdin.read()
+            else:
+                with open(md_file) as f:
+                    text = f.read()
+        except OSError as e:
+            print('md-tw: {}: {}'.format(md_file, e.strerror),
+                  file=sys.stderr)
+            status = 1
+            continue
+
+        try:
+            try:
+                wrapped = request(text, options, a.socket)
+            except OSError:
+                from md_tw import TWMarkdown
+
+                wrapped = TWMarkdown(**options)(text)
+        except (DaemonError, ValueError) as e:
+            print('md-tw: {}: {}'.format(md_file, e), file=sys.stderr)
+            status = 1
+            continue
+
+        sys.stdout.write(wrapped)
+        sys.stdout.write('\n')
+
+    return status
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+"""
+Markdown files changed in a git repository.
+"""
+
+import os
+import subprocess
+
+
+class GitError(Exception):
+    """Error reported by git."""
+
+
+def _git(*args):
+    p = subprocess.run(('git',) + args, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+    if p.returncode:
+        raise GitError(p.stderr.decode('utf-8', 'replace').strip())
+
+    return p.stdout.decode('utf-8', 'surrogateescape')
+
+
+def changed_files(ref=None, staged=False, paths=()):
+    """Markdown files changed in the git repository of the current
+    directory.
+
+    Files changed since ref, a commit, or with staged, the changes
+    staged for the next commit; both can be given.  paths limit the
+    files to those paths.  Deleted files are left out.  Returns the
+    paths of the files, relative to the current directory.
+    """
+    from md_tw import _md_extensions
+
+    top = _git('rev-parse', '--show-toplevel').rstrip('\n')
+
+    args = ['diff', '--name-only', '-z', '--no-renames', '--diff-filter=d']
+    if staged:
+        args.append('--cached')
+    if ref:
+        if ref.startswith('-'):
+            raise GitError("bad revision '{}'".format(ref))
+        args.append(ref)
+    args.append('--')
+    args.extend(paths)
+
+    return [os.path.relpath(os.path.join(top, f))
+            for f in _git(*args).split('\0')
+            if f.endswith(_md_extensions)]
@@ -18,62 +18,541 @@
 #   along with markdown-textwrap (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
-import argparse
+import collections
+import functools
+import itertools
+import os
 import re
+import sys
 import textwrap
+import threading
+import time
 
 import mistune
 
+from markdown_textwrap import columns
+from markdown_textwrap._version import __version__
+
+
+class _LazyPattern(object):
+    """Regular expression that is compiled when it is first used, so
+    that importing md_tw does not compile patterns it may not need.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self._args = pattern, flags
+
+    def __getattr__(self, name):
+        # Only called for attributes not looked up before; re.compile
+        # caches the compiled pattern.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = getattr(re.compile(*self._args), name)
+        setattr(self, name, value)
+        return value
+
+
+# Patterns used to find top-level block boundaries in a stream of
+# lines; see _iter_chunks and TWBlockLexer.parse_chunks.
+_line_pattern = _LazyPattern(r'[^\n]*\n|[^\n]+')
+# A line of the source, as mistune.preprocessing will see it.
+_source_line_pattern = _LazyPattern(
+    '[^\n\r\u2424]*(?:\r\n|[\n\r\u2424])|[^\n\r\u2424]+'
+)
+_blank_line_pattern = _LazyPattern(r'^[ \t\r\n]*$')
+_list_bullet_pattern = _LazyPattern(r'^(?:[*+-]|\d+\.) ')
+# A list item with nothing after its bullet takes in the blank line
+# that follows it.
+_bare_bullet_pattern = _LazyPattern(
+    r'^ *(?:[*+-]|\d+\.) (?:\r\n|[\n\r\u2424])'
+)
+# Where _iter_chunks would cut a preprocessed document, after its
+# first line; see _iter_text_chunks.  The cut before the first line
+# has a pattern of its own, as an \A in the other pattern makes it
+# much slower.
+_chunk_cut_pattern = _LazyPattern(
+    r'\n(\n+)(?=[^ >\n])(?!(?:[*+-]|\d+\.) )'
+)
+_first_chunk_cut_pattern = _LazyPattern(
+    r'\n+(?=[^ >\n])(?!(?:[*+-]|\d+\.) )'
+)
+_opener_pattern = _LazyPattern(
+    r'^ *(?:(`{3,}|~{3,})|<(!--|%s)|(\[))' % mistune._block_tag,
+    flags=re.M
+)
+_bracket_closer_pattern = _LazyPattern(r'\]')
+_tag_end_pattern = _LazyPattern(r'>')
+# A line that may define a footnote, in a block quote too.
+_footnote_def_pattern = _LazyPattern(r'^[ >]*\[\^', flags=re.M)
+
+
+def _iter_lines(lines):
+    """Split lines further at the line breaks that
+    mistune.preprocessing introduces.
+    """
+    for line in lines:
+        if '\r' in line or '\u2424' in line:
+            line = mistune.preprocessing(line)
+            yield from _line_pattern.findall(line)
+        else:
+            yield line
+
+
+def _is_chunk_start(text, pos):
+    """Tell if _iter_chunks could cut a chunk at pos in text."""
+    if pos == 0:
+        return True
+    if pos >= len(text) or text[pos - 1] not in '\n\r\u2424':
+        return False
+
+    def line_start(end):
+        # Start of the line before the line at end.
+        end -= 2 if text.startswith('\r\n', end - 2) else 1
+        return max(text.rfind(c, 0, end) for c in '\n\r\u2424') + 1
+
+    blank_start = line_start(pos)
+    line = _line_pattern.match(text, pos).group(0)
+
+    if not (_blank_line_pattern.match(text[blank_start:pos])
+            and not _blank_line_pattern.match(line)
+            and line[0] not in ' \t>'
+            and not _list_bullet_pattern.match(line)):
+        return False
+
+    return not (blank_start
+                and _bare_bullet_pattern.match(
+                    text[line_start(blank_start):blank_start]))
+
+
+def _iter_chunks(lines):
+    """Group lines into chunks of top-level blocks.
+
+    A chunk is cut before a line that follows a blank line and does
+    not start with whitespace, a list bullet or a `>`.  Fenced code
+    blocks, block level HTML and definitions may still span chunks;
+    see TWBlockLexer.parse_chunks.
+    """
+    chunk = []
+    blanks = 0
+    bare = False
+
+    for line in _iter_lines(lines):
+        # Same as _blank_line_pattern.match(line), but quicker.
+        line_blank = not line.strip(' \t\r\n')
+
+        if (blanks and not line_blank
+            and not (bare and blanks == 1)
+            and line[:1] not in ' \t>'
+            and not _list_bullet_pattern.match(line)):
+            yield ''.join(chunk)
+            chunk = []
+
+        if line_blank:
+            if not blanks and chunk:
+                bare = bool(_bare_bullet_pattern.match(chunk[-1]))
+            blanks += 1
+        else:
+            blanks = 0
+        chunk.append(line)
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _iter_text_chunks(text):
+    """Same as _iter_chunks, for a document preprocessed by
+    mistune.preprocessing, without going through it line by line.
+    """
+    m = _first_chunk_cut_pattern.match(text)
+    start = m.end() if m else 0
+    if start:
+        yield text[:start]
+
+    for m in _chunk_cut_pattern.finditer(text, start):
+        if len(m.group(1)) == 1:
+            line_start = text.rfind('\n', 0, m.start()) + 1
+            if _bare_bullet_pattern.match(text[line_start:m.start() + 1]):
+                continue
+
+        yield text[start:m.end()]
+        start = m.end()
+
+    if start < len(text):
+        yield text[start:]
+
+
+class TWToken(object):
+    """Token of TWBlockLexer.
+
+    Tokens are slotted objects rather than the dicts mistune makes,
+    to keep the tokens of big documents small.  Fields are read as
+    attributes, or like mistune's dicts: token['text'],
+    token.get('lang').
+    """
+    __slots__ = ('type',)
+
+    def __init__(self, type):
+        self.type = type
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __contains__(self, key):
+        return key in self.as_dict()
+
+    def as_dict(self):
+        """The token as a mistune token dict."""
+        return dict((f, getattr(self, f)) for cls in type(self).__mro__
+                    for f in getattr(cls, '__slots__', ())
+                    if hasattr(self, f))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.as_dict())
+
+
+class TWTextToken(TWToken):
+    """paragraph, text, hrule, def_link and block_html tokens."""
+    __slots__ = ('text',)
+
+    def __init__(self, type, text):
+        self.type = type
+        self.text = text
+
+
+class TWCodeToken(TWTextToken):
+    __slots__ = ('lang',)
+
+    def __init__(self, text, lang=None):
+        self.type = 'code'
+        self.text = text
+        self.lang = lang
+
+
+class TWHeadingToken(TWTextToken):
+    __slots__ = ('level',)
+
+    def __init__(self, text, level):
+        self.type = 'heading'
+        self.text = text
+        self.level = level
+
+
+class TWListToken(TWToken):
+    __slots__ = ('ordered',)
+
+    def __init__(self, ordered):
+        self.type = 'list_start'
+        self.ordered = ordered
+
+
+class TWIndentToken(TWToken):
+    """list_item_end, block_quote_end and footnote_end tokens; spaces
+    is the indent of the item, quote or footnote they end.
+    """
+    __slots__ = ('spaces',)
+
+    def __init__(self, type, spaces):
+        self.type = type
+        self.spaces = spaces
+
+
+class TWItemToken(TWIndentToken):
+    """list_item_start, loose_item_start and block_quote_start tokens;
+    text is the bullet or the quote marker.
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, type, text):
+        self.type = type
+        self.text = text
+        self.spaces = len(text)
+
+
+class TWFootnoteToken(TWIndentToken):
+    __slots__ = ('key', 'multiline')
+
+    def __init__(self, type, key, spaces, multiline=False):
+        self.type = type
+        self.key = key
+        self.spaces = spaces
+        self.multiline = multiline
+
+
+class TWTableToken(TWToken):
+    __slots__ = ('header', 'align', 'cells')
+
+    def __init__(self, type, header, align, cells):
+        self.type = type
+        self.header = header
+        self.align = align
+        self.cells = cells
+
+
+# Tokens with no fields but their type.
+_newline_token = TWToken('newline')
+_list_end_token = TWToken('list_end')
+
+# Classes of tokens, and their fields, as TWTokenCache keeps them.
+_token_classes = [TWToken, TWTextToken, TWCodeToken, TWHeadingToken,
+                  TWListToken, TWIndentToken, TWItemToken, TWFootnoteToken,
+                  TWTableToken]
+_token_fields = [tuple(f for c in reversed(cls.__mro__)
+                       for f in getattr(c, '__slots__', ()))
+                 for cls in _token_classes]
+
+
+class _TWLocal(object):
+    """Attribute with a value of its own in each thread.
+
+    A thread that hasn't set the attribute gets the value factory
+    returns.  The instance keeps the values in its _tw_local.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+
+        values = obj._tw_local.__dict__
+        try:
+            return values[self.name]
+        except KeyError:
+            value = values[self.name] = self.factory()
+            return value
+
+    def __set__(self, obj, value):
+        obj._tw_local.__dict__[self.name] = value
+
 
 class TWBlockLexer(mistune.BlockLexer):
-    """Text Wrap Block lexer for block grammar."""
+    """Text Wrap Block lexer for block grammar.
+
+    The state of a lex is kept per thread, so that threads can share a
+    lexer.
+    """
+
+    # from mistune
+    _block_quote_leading_pattern = _LazyPattern(r'^ *> ?', flags=re.M)
+    _key_pattern = _LazyPattern(r'\s+')
+
+    tokens = _TWLocal(list)
+    def_links = _TWLocal(dict)
+    def_footnotes = _TWLocal(dict)
 
     def __init__(self, rules=None, **kwargs):
+        self._tw_local = threading.local()
+
         super(TWBlockLexer, self).__init__(rules, **kwargs)
 
-        # from mistune
-        self._block_quote_leading_pattern = re.compile(r'^ *> ?', flags=re.M)
-        self._key_pattern = re.compile(r'\s+')
+        # id of a list of rules -> the list and the match methods and
+        # handlers of its rules; see _manipulate.
+        self._handlers = {}
 
     # from mistune
     def _keyify(self, key):
         key = mistune.escape(key.lower(), quote=True)
         return self._key_pattern.sub(' ', key)
 
+    def _manipulate(self, rules):
+        # from mistune with minor changes; the rules and their
+        # handlers are looked up once per list of rules.
+        cached = self._handlers.get(id(rules))
+        if cached and cached[0] is rules:
+            handlers = cached[1]
+        else:
+            handlers = [(getattr(self.rules, key).match,
+                         getattr(self, 'parse_%s' % key))
+                        for key in rules]
+            self._handlers[id(rules)] = rules, handlers
+
+        def manipulate(text):
+            for match, handler in handlers:
+                m = match(text)
+                if not m:
+                    continue
+                handler(m)
+                return m
+            return False  # pragma: no cover
+
+        return manipulate
+
+    def parse(self, text, rules=None):
+        # from mistune
+        text = text.rstrip('\n')
+
+        if not rules:
+            rules = self.default_rules
+
+        manipulate = self._manipulate(rules)
+        while text:
+            m = manipulate(text)
+            if m is False:  # pragma: no cover
+                raise RuntimeError('Infinite loop at: %s' % text)
+
+            text = text[len(m.group(0)):]
+        return self.tokens
+
+    def parse_blocks(self, text, rules=None):
+        """Lex text one top-level block at a time.
+
+        Yields the source and the list of tokens of each top-level
+        block.  Unlike parse, trailing newlines are not stripped from
+        text, so that a document may be lexed in chunks.
+        """
+        if not rules:
+            rules = self.default_rules
+
+        manipulate = self._manipulate(rules)
+        while text:
+            self.tokens = []
+            m = manipulate(text)
+            if m is False:  # pragma: no cover
+                raise RuntimeError('Infinite loop at: %s' % text)
+
+            text = text[len(m.group(0)):]
+            yield m.group(0), self.tokens
+
+        self.tokens = []
+
+    def _closers(self, text, start, end, tokens):
+        """Patterns of the closing markers that, if they showed up
+        later in the document, could make a fence, an HTML block or a
+        definition out of the top-level block text[start:end].
+
+        Markers that already show up in text after their opening
+        marker are left out.  With tokens None, text[start:end] may
+        be any blocks.
+        """
+        kind = tokens[0].type if tokens else None
+        if tokens is not None and kind not in (
+                'paragraph', 'text', 'heading', 'list_start', 'block_html'):
+            return []
+
+        closers = []
+        for m in _opener_pattern.finditer(text, start, end):
+            fence, tag, bracket = m.groups()
+            pos = m.end()
+            if kind == 'block_html':
+                # A lone opening tag may get its closing tag later.
+                if m.start() > start or not tag:
+                    break
+            if bracket:
+                # The key of a definition may span lines.
+                candidates = [_bracket_closer_pattern]
+            elif kind == 'list_start':
+                continue
+            elif fence:
+                # The closing fence is on a later line, and may be
+                # as short as three characters.
+                pos = text.find('\n', pos)
+                candidates = [re.compile(r'%s *$' % fence[:3], flags=re.M)]
+            elif tag == '!--':
+                candidates = [re.compile(r'--> *(?:\n\n|\s*$)')]
+            else:
+                # The attributes of the tag may span lines too.
+                candidates = [_tag_end_pattern,
+                              re.compile(r'</%s> *(?:\n\n|\s*$)' % tag)]
+
+            closers.extend(c for c in candidates
+                           if pos < 0 or not c.search(text, pos))
+
+        return closers
+
+    def _parse_text(self, text):
+        """parse_blocks, along with the closers of each block; see
+        _closers.
+        """
+        pos = 0
+        for source, tokens in self.parse_blocks(text):
+            closers = self._closers(text, pos, pos + len(source), tokens)
+            pos += len(source)
+            yield source, tokens, closers
+
+    def parse_chunks(self, chunks, end=True):
+        """Lex a document given as chunks of whole lines.
+
+        Yields the source, tokens and closers of each top-level block;
+        see parse_blocks.  Blocks that may turn into another block
+        once a closing marker shows up are held back and lexed again
+        with the chunks that follow.  end tells if the chunks run to
+        the end of the document; if not, trailing newlines are kept,
+        and the last blocks are yielded with their closers.
+        """
+        carry = ''
+        closers = []
+        text = None
+
+        for next_text in chunks:
+            if text is None:
+                text = next_text
+                continue
+            if closers and not any(c.search(text) for c in closers):
+                carry += text
+                text = next_text
+                continue
+
+            text = carry + text
+
+            blocks = []
+            closers = []
+            for block in self._parse_text(text):
+                if block[2]:
+                    closers = block[2]
+                    break
+                blocks.append(block)
+
+            # Held back blocks are lexed again with the next chunk.
+            carry = text[sum(len(b[0]) for b in blocks):] if closers else ''
+
+            yield from blocks
+            text = next_text
+
+        if text is not None:
+            text = carry + text
+            if end:
+                text = text.rstrip('\n')
+            yield from self._parse_text(text)
+
+    def parse_newline(self, m):
+        # from mistune
+        if len(m.group(0)) > 1:
+            self.tokens.append(_newline_token)
+
     def parse_block_code(self, m):
-        self.tokens.append({
-            'type': 'code',
-            'lang': None,
-            'text': m.group(0),
-        })
+        self.tokens.append(TWCodeToken(m.group(0)))
 
     def parse_fences(self, m):
-        self.tokens.append({
-            'type': 'code',
-            'lang': None,
-            'text': m.group(0),
-        })
+        self.tokens.append(TWCodeToken(m.group(0)))
 
     def parse_heading(self, m):
-        self.tokens.append({
-            'type': 'heading',
-            'level': len(m.group(1)),
-            'text': m.group(0),
-        })
+        self.tokens.append(TWHeadingToken(m.group(0), len(m.group(1))))
 
     def parse_lheading(self, m):
         """Parse setext heading."""
-        self.tokens.append({
-            'type': 'heading',
-            'level': 1 if m.group(2) == '=' else 2,
-            'text': m.group(0),
-        })
+        self.tokens.append(
+            TWHeadingToken(m.group(0), 1 if m.group(2) == '=' else 2)
+        )
 
     def parse_hrule(self, m):
-        self.tokens.append({
-            'type': 'hrule',
-            'text': m.group(0)
-            })
+        self.tokens.append(TWTextToken('hrule', m.group(0)))
+
+    def parse_list_block(self, m):
+        # from mistune
+        bull = m.group(2)
+        self.tokens.append(TWListToken('.' in bull))
+        self._process_list_item(m.group(0), bull)
+        self.tokens.append(_list_end_token)
 
     def _process_list_item(self, cap, bull):
         # from mistune with minor changes.
@@ -116,19 +595,12 @@ class TWBlockLexer(mistune.BlockLexer):
             else:
                 t = 'list_item_start'
 
-            self.tokens.append({
-                'type': t,
-                'text': bullet,
-                'spaces': len(bullet)
-                })
+            self.tokens.append(TWItemToken(t, bullet))
 
             # recurse
             self.parse(item, self.list_rules)
 
-            self.tokens.append({
-                'type': 'list_item_end',
-                'spaces': len(bullet)
-                })
+            self.tokens.append(TWIndentToken('list_item_end', len(bullet)))
 
     def parse_block_quote(self, m):
         # slurp and clean leading >
@@ -139,16 +611,9 @@ class TWBlockLexer(mistune.BlockLexer):
 
         cap = self._block_quote_leading_pattern.sub('', m.group(0))
 
-        self.tokens.append({
-            'type': 'block_quote_start',
-            'text': quote,
-            'spaces': len(quote)
-            })
+        self.tokens.append(TWItemToken('block_quote_start', quote))
         self.parse(cap)
-        self.tokens.append({
-            'type': 'block_quote_end',
-            'spaces': len(quote)
-            })
+        self.tokens.append(TWIndentToken('block_quote_end', len(quote)))
 
     def parse_def_links(self, m):
         key = self._keyify(m.group(1))
@@ -156,10 +621,7 @@ class TWBlockLexer(mistune.BlockLexer):
             'link': m.group(2),
             'title': m.group(3),
         }
-        self.tokens.append({
-            'type': 'def_link',
-            'text': m.group(0)
-            })
+        self.tokens.append(TWTextToken('def_link', m.group(0)))
 
     def parse_def_footnotes(self, m):
         key = m.group(1)
@@ -188,26 +650,33 @@ class TWBlockLexer(mistune.BlockLexer):
             if whitespace:
                 spaces = whitespace
 
-        self.tokens.append({
-            'type': 'footnote_start',
-            'key': key,
-            'multiline': multiline,
-            'spaces': spaces
-        })
+        self.tokens.append(
+            TWFootnoteToken('footnote_start', key, spaces, multiline)
+        )
 
         self.parse(text, self.footnote_rules)
 
-        self.tokens.append({
-            'type': 'footnote_end',
-            'key': key,
-            'spaces': spaces
-        })
+        self.tokens.append(TWFootnoteToken('footnote_end', key, spaces))
 
     def parse_block_html(self, m):
-        self.tokens.append({
-            'type': 'block_html',
-            'text': m.group(0)
-            })
+        self.tokens.append(TWTextToken('block_html', m.group(0)))
+
+    def parse_table(self, m):
+        super(TWBlockLexer, self).parse_table(m)
+        self.tokens.append(TWTableToken(**self.tokens.pop()))
+
+    def parse_nptable(self, m):
+        super(TWBlockLexer, self).parse_nptable(m)
+        self.tokens.append(TWTableToken(**self.tokens.pop()))
+
+    def parse_paragraph(self, m):
+        # from mistune
+        text = m.group(1).rstrip('\n')
+        self.tokens.append(TWTextToken('paragraph', text))
+
+    def parse_text(self, m):
+        # from mistune
+        self.tokens.append(TWTextToken('text', m.group(0)))
 
 
 class TWInlineLexer(mistune.InlineLexer):
@@ -221,15 +690,471 @@ class TWInlineLexer(mistune.InlineLexer):
         return text
 
 
+class TWTextWrapper(textwrap.TextWrapper):
+    """Text Wrap greedy fill engine.
+
+    Same output as textwrap.TextWrapper for the options TWRenderer
+    uses, in less time: text without hyphens is split into words with
+    a plain pattern and lines are sliced out of the list of chunks
+    instead of being popped off it one chunk at a time.
+
+    With measure 'display', lines are measured in the columns a
+    terminal shows them in, see markdown_textwrap.columns, instead of
+    in characters.
+    """
+
+    _chunk_pattern = _LazyPattern(r' +|[^ ]+')
+
+    def __init__(self, measure='chars', **kwargs):
+        super(TWTextWrapper, self).__init__(**kwargs)
+
+        if measure not in ('chars', 'display'):
+            raise ValueError('unknown measure: {}'.format(measure))
+        self.measure = measure
+
+    def wrap(self, text):
+        # from textwrap
+        chunks = self._split_chunks(text)
+        if self.fix_sentence_endings:
+            self._fix_sentence_endings(chunks)
+
+        # ASCII characters take a column each.
+        if self.measure == 'chars' or text.isascii():
+            return self._wrap_chunks(chunks)
+
+        return self._wrap_chunks(chunks, columns.width)
+
+    def _split(self, text):
+        # Only hyphens and em-dashes make textwrap split words.
+        if '-' in text:
+            return super(TWTextWrapper, self)._split(text)
+
+        return self._chunk_pattern.findall(text)
+
+    def _wrap_chunks(self, chunks, width_of=len):
+        if self.max_lines is not None:
+            return super(TWTextWrapper, self)._wrap_chunks(chunks)
+        if self.width <= 0:
+            raise ValueError('invalid width %r (must be > 0)' % self.width)
+
+        drop = self.drop_whitespace
+        lengths = [width_of(c) for c in chunks]
+        lines = []
+        indent = self.initial_indent
+        width = self.width - width_of(indent)
+        i, n = 0, len(chunks)
+
+        while i < n:
+            if lines:
+                indent = self.subsequent_indent
+                width = self.width - width_of(indent)
+
+                # Drop whitespace at the start of the line; the rest of
+                # a broken long word may be empty.
+                if drop and (not chunks[i] or chunks[i].isspace()):
+                    i += 1
+                    if i == n:
+                        break
+
+            start = i
+            cur_len = 0
+            while i < n and cur_len + lengths[i] <= width:
+                cur_len += lengths[i]
+                i += 1
+            cur_line = chunks[start:i]
+
+            if i < n and lengths[i] > width:
+                # from textwrap; breaks the long word.
+                rest = [chunks[i]]
+                if width_of is len:
+                    self._handle_long_word(rest, cur_line, cur_len, width)
+                else:
+                    # textwrap breaks the word after width - cur_len
+                    # characters; make that the characters that fit in
+                    # the columns left, at least one on an empty line.
+                    fit = columns.fit(chunks[i], width - cur_len)
+                    if not (fit or cur_line):
+                        fit = 1
+                    self._handle_long_word(rest, cur_line, width - fit,
+                                           width)
+                if rest:
+                    chunks[i] = rest[-1]
+                    lengths[i] = width_of(rest[-1])
+                else:  # pragma: no cover
+                    i += 1
+
+            # Drop whitespace at the end of the line.
+            if drop and cur_line and (not cur_line[-1]
+                                      or cur_line[-1].isspace()):
+                del cur_line[-1]
+
+            if cur_line:
+                lines.append(indent + ''.join(cur_line))
+
+        return lines
+
+
+class TWOptimalWrapper(TWTextWrapper):
+    """Text Wrap minimum raggedness fill engine.
+
+    Picks the line breaks that minimize the sum of the squares of the
+    space left at the end of every line but the last one.  Breaks are
+    found in O(n log n) time for n words: the cost of a line is a
+    convex function of its length, so a line starting at a later word
+    that is cheaper for some line end stays cheaper for all the line
+    ends after it, and the candidate line starts are kept in a queue.
+    """
+
+    def _wrap_chunks(self, chunks, width_of=len):
+        if self.width <= 0:
+            raise ValueError('invalid width %r (must be > 0)' % self.width)
+
+        widths = [self.width - width_of(self.initial_indent),
+                  self.width - width_of(self.subsequent_indent)]
+
+        # Start and end of the words in the joined chunks; words longer
+        # than a line are broken.
+        piece = max(min(widths), 1)
+        starts = []
+        ends = []
+        pos = 0
+        if width_of is len:
+            for c in chunks:
+                if c and not c.isspace():
+                    for p in range(pos, pos + len(c), piece):
+                        starts.append(p)
+                        ends.append(min(p + piece, pos + len(c)))
+                pos += len(c)
+            col_starts, col_ends = starts, ends
+        else:
+            # The same in columns, to measure lines with.
+            col_starts = []
+            col_ends = []
+            col = 0
+            for c in chunks:
+                if c and not c.isspace():
+                    p = 0
+                    while p < len(c):
+                        n = max(columns.fit(c[p:], piece), 1)
+                        starts.append(pos + p)
+                        ends.append(pos + p + n)
+                        col_starts.append(col)
+                        col += width_of(c[p:p + n])
+                        col_ends.append(col)
+                        p += n
+                else:
+                    col += width_of(c)
+                pos += len(c)
+
+        n = len(starts)
+        if not n:
+            return []
+
+        # More than the cost of any fill without overfull lines.
+        overfull = n * max(max(widths), 1) ** 2 + 1
+
+        def cost(i, j, width):
+            """Cost of a line with words i to j - 1."""
+            slack = width - (col_ends[j - 1] - col_starts[i])
+            if slack < 0:
+                return overfull * slack * slack
+            return slack * slack
+
+        # best[j] is the least cost of the lines before word j when a
+        # line starts at word j, and prev[j] is where that line starts.
+        best = [0] * (n + 1)
+        prev = [0] * (n + 1)
+
+        def total(i, j):
+            return best[i] + cost(i, j, widths[1])
+
+        # Line starts, other than the first word, that may be the best
+        # for some line end, along with the first line end they are
+        # the best for.
+        queue = collections.deque()
+        for j in range(1, n + 1):
+            while len(queue) > 1 and queue[1][1] <= j:
+                queue.popleft()
+
+            best[j] = cost(0, j, widths[0])
+            if queue and total(queue[0][0], j) < best[j]:
+                prev[j] = queue[0][0]
+                best[j] = total(prev[j], j)
+            if j == n:
+                break
+
+            # Find the first line end that j is a better start for.
+            while queue:
+                i, end = queue[-1]
+                end = max(end, j + 1)
+                if total(j, end) > total(i, end):
+                    break
+                queue.pop()
+            if not queue:
+                queue.append((j, j + 1))
+                continue
+
+            lo, hi = end, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if total(j, mid) <= total(i, mid):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            if total(j, lo) <= total(i, lo):
+                queue.append((j, lo))
+
+        # The last line costs nothing, as long as it fits.
+        def last_cost(i):
+            width = widths[1] if i else widths[0]
+            slack = width - (col_ends[n - 1] - col_starts[i])
+            return best[i] + (overfull * slack * slack if slack < 0 else 0)
+
+        breaks = [n]
+        i = min(range(n), key=last_cost)
+        while i:
+            breaks.append(i)
+            i = prev[i]
+        breaks.append(0)
+        breaks.reverse()
+
+        text = ''.join(chunks)
+        lines = []
+        for i, j in zip(breaks, breaks[1:]):
+            indent = self.subsequent_indent if lines else self.initial_indent
+            lines.append(indent + text[starts[i]:ends[j - 1]])
+
+        return lines
+
+
+class TWBatchWrapper(TWTextWrapper):
+    """Text Wrap greedy fill engine that fills many paragraphs at once.
+
+    fill_many finds the line breaks of all the paragraphs it is given
+    with NumPy: the paragraphs are joined into one array of code
+    points, which is cut into runs of spaces and runs of other
+    characters, the chunks TWTextWrapper splits text into; each
+    searchsorted over the cumulative lengths of the chunks then ends a
+    line of every paragraph at once.  The output is the same as
+    TWTextWrapper's.
+    """
+
+    # Whitespace that is left as it is by _munge_whitespace.
+    _other_space_pattern = _LazyPattern(r'[^\S ]')
+
+    def _batched(self, text, ctx):
+        # Paragraphs left to TWTextWrapper: textwrap splits words at
+        # hyphens; a line of leading whitespace alone is dropped
+        # without starting a line; columns are characters for ASCII
+        # text only.
+        return not ('-' in text
+                    or text.startswith(' ')
+                    or self._other_space_pattern.search(text)
+                    or not ctx.drop_whitespace
+                    or max(len(ctx.initial_indent),
+                           len(ctx.subsequent_indent)) >= ctx.width
+                    or (self.measure != 'chars'
+                        and not (text + ctx.initial_indent
+                                 + ctx.subsequent_indent).isascii()))
+
+    def batches(self):
+        """Tell if fill_many fills paragraphs in batches; it needs NumPy
+        and textwrap's default options.
+        """
+        if (self.max_lines is not None or self.fix_sentence_endings
+                or not (self.break_long_words and self.break_on_hyphens)):
+            return False
+        try:
+            import numpy
+        except ImportError:
+            return False
+
+        return True
+
+    def fill_many(self, items):
+        """Fill items, pairs of text and TWContext.
+
+        Returns the fill of each item; None for those that are left to
+        TWTextWrapper, which are all of them if it does not fill in
+        batches, see batches.  Paragraphs with words longer than a line
+        are left too.
+        """
+        fills = [None] * len(items)
+        if not self.batches():
+            return fills
+
+        import numpy as np
+
+        which = []
+        texts = []
+        for k, (text, ctx) in enumerate(items):
+            text = self._munge_whitespace(text)
+            if self._batched(text, ctx):
+                which.append(k)
+                texts.append(text)
+        if not texts:
+            return fills
+
+        n = len(texts)
+        ctxs = [items[k][1] for k in which]
+        widths = np.array([[c.width - len(c.initial_indent),
+                            c.width - len(c.subsequent_indent)]
+                           for c in ctxs], dtype=np.intp)
+
+        # Paragraphs are joined with newlines, which are neither spaces
+        # nor in any paragraph.
+        joined = '\n'.join(texts)
+        codes = np.frombuffer(joined.encode('utf-32-le', 'surrogatepass'),
+                              dtype=np.uint32)
+        starts = np.zeros(n, dtype=np.intp)
+        ends = np.empty(n, dtype=np.intp)
+        np.cumsum([len(t) + 1 for t in texts], out=ends)
+        starts[1:] = ends[:-1]
+        ends -= 1
+
+        # Start of each chunk, and the end of the last one.
+        space = np.append(codes == 32, False)
+        cuts = np.zeros(len(codes) + 1, dtype=bool)
+        cuts[1:-1] = space[1:-1] != space[:-2]
+        cuts[starts] = True
+        cuts[ends] = True
+        pos = np.flatnonzero(cuts)
+        chunk_space = space[pos]
+        first = np.searchsorted(pos, starts)
+        last = np.searchsorted(pos, ends)
+
+        # Paragraphs with a chunk longer than a line are left out.
+        owner = np.searchsorted(first, np.arange(len(pos) - 1),
+                                side='right') - 1
+        long_ = np.diff(pos) > widths.min(axis=1)[owner]
+        left = np.zeros(n, dtype=bool)
+        left[owner[long_]] = True
+
+        ids = np.flatnonzero(~left)
+        p = first[ids]
+        stop = last[ids]
+        width = widths[ids, 0]
+        rows = []
+        while len(ids):
+            # The line takes the chunks that fit.
+            e = np.searchsorted(pos, pos[p] + width, side='right') - 1
+            e = np.minimum(e, stop)
+            rows.append((ids, p, e))
+
+            # Whitespace at the start of the next line is dropped.
+            p = e + (chunk_space[e] & (e < stop))
+            more = p < stop
+            ids, p, stop = ids[more], p[more], stop[more]
+            width = widths[ids, 1]
+
+        lines = [[] for t in texts]
+        if rows:
+            ids, p, e = (np.concatenate(r) for r in zip(*rows))
+            # Whitespace at the end of a line is dropped.
+            e -= chunk_space[e - 1]
+            order = np.argsort(ids, kind='stable')
+            for i, a, b in zip(ids[order].tolist(), pos[p[order]].tolist(),
+                               pos[e[order]].tolist()):
+                if a < b:
+                    lines[i].append(joined[a:b])
+
+        for i in np.flatnonzero(~left).tolist():
+            ctx = ctxs[i]
+            out = lines[i]
+            if out:
+                out[0] = ctx.initial_indent + out[0]
+                out[1:] = [ctx.subsequent_indent + l for l in out[1:]]
+            fills[which[i]] = '\n'.join(out)
+
+        return fills
+
+
+# Greedy fill engines selected with TWMarkdown(tw_engine=...); see
+# also TWMarkdown(tw_mode=...).
+_tw_engines = {
+    'fast': TWTextWrapper,
+    'batch': TWBatchWrapper,
+    'textwrap': textwrap.TextWrapper,
+}
+
+
+class TWContext(collections.namedtuple('TWContext', [
+        'width', 'initial_indent', 'subsequent_indent', 'drop_whitespace'
+])):
+    """Options a block is rendered with.
+
+    A context is never changed: nested blocks are rendered with a new
+    context made by indent.
+    """
+    __slots__ = ()
+
+    def indent(self, prefix, width=None):
+        """Context with prefix added to the initial indent, which both
+        indents are set to, and with width, if given.
+        """
+        p = self.initial_indent + prefix
+
+        return self._replace(width=self.width if width is None else width,
+                             initial_indent=p, subsequent_indent=p)
+
+
 class TWRenderer(mistune.Renderer):
-    """Text Wrap Renderer."""
+    """Text Wrap Renderer.
+
+    Blocks are rendered with the TWContext they are given, or with the
+    renderer's own options, see tw_set, so that threads can share a
+    renderer.
+    """
+
+    # Text and TWContext of the paragraphs tw_fill was asked to fill,
+    # which it only collects while this is set, and fills made
+    # beforehand, see tw_fill_many, that it returns while this is set.
+    tw_collected = _TWLocal(lambda: None)
+    tw_filled = _TWLocal(lambda: None)
 
     def __init__(self, **kwargs):
+        self._tw_local = threading.local()
+
         super(TWRenderer, self).__init__(**kwargs)
 
+        engine = kwargs.get('tw_engine', 'fast')
+        if engine not in _tw_engines:
+            raise ValueError('unknown tw_engine: {}'.format(engine))
+
+        mode = kwargs.get('tw_mode', 'greedy')
+        if mode == 'optimal':
+            if engine != 'fast':
+                raise ValueError('tw_mode optimal needs tw_engine fast')
+            wrapper = TWOptimalWrapper
+        elif mode == 'greedy':
+            wrapper = _tw_engines[engine]
+        else:
+            raise ValueError('unknown tw_mode: {}'.format(mode))
+
+        # Options of the wrappers other than those of a TWContext.
+        measure = kwargs.get('tw_measure', 'chars')
+        if measure == 'display':
+            if engine == 'textwrap':
+                raise ValueError('tw_measure display needs tw_engine fast '
+                                 'or batch')
+            self._tw_options = {'measure': measure}
+        elif measure == 'chars':
+            self._tw_options = {}
+        else:
+            raise ValueError('unknown tw_measure: {}'.format(measure))
+
         # Initalize textwrap.TextWrapper class
-        self.tw = textwrap.TextWrapper(
-            width=kwargs.get('tw_width', 72)
+        self.tw = wrapper(
+            width=kwargs.get('tw_width', 72),
+            **self._tw_options
+        )
+
+        # Fills of recently seen text, kept across documents.
+        self._tw_fill_cached = functools.lru_cache(
+            maxsize=kwargs.get('tw_cache_size', 1024)
+        )(self._tw_fill)
+        self._tw_wrapper_cached = functools.lru_cache(maxsize=64)(
+            self._tw_wrapper
         )
 
     def tw_get(self, attr):
@@ -257,15 +1182,75 @@ class TWRenderer(mistune.Renderer):
             # Set option
             setattr(self.tw, opt, val)
 
-    def tw_fill(self, text, **kwargs):
-        """Wrap text.
+    def context(self):
+        """TWContext of the options of the local textwrap.TextWrapper
+        instance.
+        """
+        return TWContext(self.tw.width, self.tw.initial_indent,
+                         self.tw.subsequent_indent, self.tw.drop_whitespace)
+
+    def tw_fill(self, text, ctx=None, **kwargs):
+        """Wrap text with ctx, a TWContext.
+
+        Without ctx, text is wrapped with the options of the local
+        textwrap.TextWrapper instance, after setting kwargs.
         """
         self.tw_set(**kwargs)
-        return self.tw.fill(text)
+        if ctx is None:
+            ctx = self.context()
+
+        if self.tw_collected is not None:
+            self.tw_collected[text, ctx] = None
+            return text
+        if self.tw_filled is not None:
+            fill = self.tw_filled.get((text, ctx))
+            if fill is not None:
+                return fill
+
+        return self._tw_fill_cached(text, *ctx)
+
+    def tw_batches(self):
+        """Tell if the fill engine fills paragraphs in batches, see
+        tw_fill_many.
+        """
+        batches = getattr(self.tw, 'batches', None)
+
+        return bool(batches and batches())
+
+    def tw_fill_many(self, items):
+        """Wrap each of items, pairs of text and TWContext, in a single
+        batch if the fill engine can, see TWBatchWrapper.
+        """
+        fill_many = getattr(self.tw, 'fill_many', None)
+        fills = fill_many(items) if fill_many else [None] * len(items)
+
+        return [self._tw_fill_cached(text, *ctx) if fill is None else fill
+                for (text, ctx), fill in zip(items, fills)]
+
+    def _tw_fill(self, text, *options):
+        # options are the TWContext text is wrapped with; they key the
+        # cache of fills.
+        return self._tw_wrapper_cached(*options).fill(text)
+
+    def _tw_wrapper(self, width, initial_indent, subsequent_indent,
+                    drop_whitespace):
+        # Wrappers made here are never changed, so threads can share
+        # them.
+        return type(self.tw)(width=width, initial_indent=initial_indent,
+                             subsequent_indent=subsequent_indent,
+                             drop_whitespace=drop_whitespace,
+                             **self._tw_options)
+
+    def tw_cache_info(self):
+        """Hits, misses, max. size and size of the cache of fills.
+        """
+        return self._tw_fill_cached.cache_info()
+
+    def block_code(self, code, lang=None, ctx=None):
+        ctx = ctx or self.context()
 
-    def block_code(self, code, lang=None):
         out = '{}'.format(code)
-        out = textwrap.indent(out, self.tw_get('initial_indent'),
+        out = textwrap.indent(out, ctx.initial_indent,
                               lambda line: len(line.strip()) > 0)
         return out
 
@@ -273,9 +1258,11 @@ class TWRenderer(mistune.Renderer):
         out = '{}\n\n'.format(text)
         return out
 
-    def block_html(self, html):
+    def block_html(self, html, ctx=None):
+        ctx = ctx or self.context()
+
         out = '{}'.format(html)
-        out = textwrap.indent(out, self.tw_get('initial_indent'),
+        out = textwrap.indent(out, ctx.initial_indent,
                               lambda line: True)
         return out
 
@@ -295,8 +1282,8 @@ class TWRenderer(mistune.Renderer):
         out = '{}\n'.format(text)
         return out
 
-    def paragraph(self, text):
-        out = self.tw_fill(text)
+    def paragraph(self, text, ctx=None):
+        out = self.tw_fill(text, ctx)
         out = '{}\n\n'.format(out)
 
         return out
@@ -310,11 +1297,107 @@ class TWRenderer(mistune.Renderer):
         return out
 
 
+class TWStats(object):
+    """Time spent in and calls of the parts of a TWMarkdown.
+
+    instrument wraps the output_* handlers of a TWMarkdown, the
+    parse_* rules of its block lexer and the tw_fill of its renderer
+    so that each call is timed; a TWMarkdown that isn't instrumented
+    is not slowed down.  Times include the time of the calls made
+    within a call, self times don't.
+    """
+
+    def __init__(self):
+        # name -> [calls, seconds, self seconds]
+        self.timings = {}
+        # Time spent in the calls made within the running calls.
+        self._inner = []
+
+    def _timed(self, name, func):
+        timings = self.timings
+        inner = self._inner
+        clock = time.perf_counter
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            inner.append(0.0)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                inner_elapsed = inner.pop()
+                if inner:
+                    inner[-1] += elapsed
+
+                t = timings.get(name)
+                if t is None:
+                    t = timings[name] = [0, 0.0, 0.0]
+                t[0] += 1
+                t[1] += elapsed
+                t[2] += elapsed - inner_elapsed
+
+        return timed
+
+    def instrument(self, md):
+        """Record the calls of md, a TWMarkdown, from now on.
+        """
+        for name in dir(md):
+            if name.startswith('output_'):
+                setattr(md, name, self._timed(name, getattr(md, name)))
+
+        block = md.block
+        rules = (set(block.default_rules) | set(block.footnote_rules)
+                 | set(block.list_rules))
+        for rule in rules:
+            name = 'parse_{}'.format(rule)
+            setattr(block, name, self._timed(name, getattr(block, name)))
+
+        md.renderer.tw_fill = self._timed('tw_fill', md.renderer.tw_fill)
+
+        # Drop the handlers the lexer has looked up already.
+        block._handlers.clear()
+
+    def merge(self, timings):
+        """Add timings, as returned by as_dict, to these.
+        """
+        for name, t in timings.items():
+            mine = self.timings.setdefault(name, [0, 0.0, 0.0])
+            mine[0] += t['calls']
+            mine[1] += t['seconds']
+            mine[2] += t['self_seconds']
+
+    def as_dict(self):
+        return dict((name, {'calls': c, 'seconds': s, 'self_seconds': ss})
+                    for name, (c, s, ss) in self.timings.items())
+
+    def flush(self):
+        """Return the timings as a dict and start over.
+        """
+        timings = self.as_dict()
+        self.timings.clear()
+
+        return timings
+
+
+# Top-level blocks rendered in a batch with TWMarkdown(tw_engine='batch').
+_batch_blocks = 512
+
+
 class TWMarkdown(mistune.Markdown):
     """Text Wrap Markdown parser.
+
+    The state of a render is kept per thread, and the options of
+    nested blocks are passed down in a TWContext, so that threads can
+    share a TWMarkdown; one with tw_stats should not be shared.
     """
 
+    tokens = _TWLocal(list)
+    token = _TWLocal(lambda: None)
+
     def __init__(self, **kwargs):
+        self._tw_local = threading.local()
+
         renderer = TWRenderer(**kwargs)
 
         super(TWMarkdown, self).__init__(
@@ -323,192 +1406,958 @@ class TWMarkdown(mistune.Markdown):
             TWBlockLexer
         )
 
-    def _clean_ts(self, lines):
-        out = ''
+        # Options to create the TWMarkdown of worker processes with.
+        self.options = dict((k, v) for k, v in kwargs.items()
+                            if k not in ('tw_stats', 'tw_token_cache'))
 
-        for line in lines.split('\n'):
-            out += line.rstrip() + '\n'
+        # A TWTokenCache to look up and keep the tokens of documents in.
+        self.token_cache = kwargs.get('tw_token_cache')
 
-        return out
+        # A TWStats to record the calls of this instance in.
+        self.stats = kwargs.get('tw_stats')
+        if self.stats is not None:
+            self.stats.instrument(self)
 
     def parse(self, text):
-        out = super(TWMarkdown, self).parse(text)
+        """Wrap text.
+
+        Top-level blocks are lexed as the renderer gets to them, and
+        the tokens of a block are dropped once it is rendered; see
+        parse_stream.
+        """
+        text = mistune.preprocessing(text)
+
+        return ''.join(self._parse_chunks(_iter_text_chunks(text)))
+
+    def parse_parallel(self, text, jobs=None, part_size=None):
+        """Wrap text in jobs worker processes.
+
+        text is split at top-level block boundaries into parts of
+        about part_size characters, which are wrapped by the workers
+        and joined in order.  The output is the same as the output of
+        parse.  jobs defaults to the number of CPUs.
+        """
+        jobs = jobs or os.cpu_count() or 1
+        text = mistune.preprocessing(text)
+        if part_size is None:
+            part_size = max(len(text) // (jobs * 4), 1 << 16)
+
+        parts = []
+        part = []
+        size = 0
+        for chunk in _iter_text_chunks(text):
+            part.append(chunk)
+            size += len(chunk)
+            if size >= part_size:
+                parts.append(''.join(part))
+                part = []
+                size = 0
+        if part or not parts:
+            parts.append(''.join(part))
+
+        pool = None
+        if jobs > 1 and len(parts) > 1:
+            import multiprocessing
+
+            pool = multiprocessing.Pool(min(jobs, len(parts)), _init_worker,
+                                        (self.options, frozenset(),
+                                         self.stats is not None))
+            last = len(parts) - 1
+            results = pool.imap(_render_part, [(p, i == last)
+                                               for i, p in enumerate(parts)])
+        else:
+            results = ((self._render_part(p, last=i == len(parts) - 1), None)
+                       for i, p in enumerate(parts))
+
+        try:
+            return ''.join(self._clean_stream(
+                self._join_parts(parts, results)
+            ))
+        finally:
+            if pool:
+                pool.terminate()
+
+    def _join_parts(self, parts, results):
+        """Yield the rendered output of parts, given the results of
+        _render_part for each part without the parts before it.
+
+        A footnote defined again in a part is dropped, like the lexer
+        does.  A part is rendered again, here, if it defines such a
+        footnote within another block, or along with the part after
+        it if it ends in a block that the part after it could change.
+        """
+        footnotes = set()
+        carry = ''
+        for i, (part, (result, timings)) in enumerate(zip(parts, results)):
+            if timings:
+                self.stats.merge(timings)
+
+            last = i == len(parts) - 1
+            if carry or any(footnotes.intersection(keys) and not note
+                            for j, keys, note in result[1]):
+                part = carry + part
+                result = self._render_part(part, footnotes, last)
+
+            outs, notes, open_ = result
+            if open_ and not last:
+                carry = part
+                continue
+
+            carry = ''
+            for j, keys, note in notes:
+                if note and footnotes.intersection(keys):
+                    outs[j] = ''
+                footnotes.update(keys)
+            yield ''.join(outs)
+
+    def _render_part(self, text, footnotes=(), last=False):
+        """Render a part of a preprocessed document; see parse_parallel.
+
+        footnotes are the keys of footnotes defined before the part;
+        last tells if the part ends the document.  Returns the
+        rendered top-level blocks of the part; the index, the keys of
+        the footnotes defined and whether it is a footnote of each
+        block that defines footnotes; and whether the last blocks of
+        the part could be changed by what follows the part.
+        """
+        self.block.def_footnotes = dict.fromkeys(footnotes, 0)
+        self.inline.setup(self.block.def_links, self.block.def_footnotes)
+
+        outs = []
+        notes = []
+        open_ = False
+        try:
+            blocks = self.block.parse_chunks(_iter_text_chunks(text), last)
+            for source, tokens, closers in blocks:
+                keys = [t.key for t in tokens if t.type == 'footnote_start']
+                if keys:
+                    notes.append((len(outs), keys,
+                                  tokens[0].type == 'footnote_start'))
+                # Only the last blocks can have closers; see
+                # TWBlockLexer.parse_chunks.
+                open_ = open_ or bool(closers)
+                outs.append(self._render(tokens))
+        finally:
+            # reset block
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+
+        return outs, notes, open_
+
+    def _clean_stream(self, outs):
+        """Clean rendered blocks as they are rendered.
+
+        Removes trailing spaces from all lines, leading and trailing
+        empty lines and makes sure the output ends with a newline.
+        """
+        started = False
+        blank = 0
+        line = ''
+
+        for out in outs:
+            lines = (line + out).split('\n')
+            line = lines.pop()
+
+            buf = []
+            for l in lines:
+                l = l.rstrip()
+                if not l:
+                    if started:
+                        blank += 1
+                    continue
+
+                buf.append('{}{}\n'.format('\n' * blank, l))
+                blank = 0
+                started = True
+
+            if buf:
+                yield ''.join(buf)
+
+        line = line.rstrip()
+        if line:
+            yield '{}{}\n'.format('\n' * blank, line)
+        elif not started:
+            yield '\n'
+
+    def _iter_render(self, tokens, ctx=None):
+        """Render tokens with ctx, a TWContext; yields the output of
+        each top-level token.
+        """
+        ctx = ctx or self.renderer.context()
+        self.tokens = tokens
+        self.tokens.reverse()
+
+        while self.pop():
+            yield self.tok(ctx)
+
+    def _render(self, tokens, ctx=None):
+        return ''.join(self._iter_render(tokens, ctx))
+
+    def _render_batches(self, blocks, ctxs=(None,)):
+        """Render blocks, the tokens of top-level blocks, with each of
+        ctxs; yields the outputs of each block, one for each ctx.
+
+        For fill engines that fill many paragraphs at once, see
+        TWBatchWrapper: blocks are rendered _batch_blocks at a time,
+        once to collect their paragraphs, which are filled in a single
+        batch, and once more with the fills.
+        """
+        renderer = self.renderer
+        blocks = iter(blocks)
+        while True:
+            batch = list(itertools.islice(blocks, _batch_blocks))
+            if not batch:
+                break
+
+            renderer.tw_collected = {}
+            try:
+                for tokens in batch:
+                    for ctx in ctxs:
+                        self._render(list(tokens), ctx)
+                items = list(renderer.tw_collected)
+            finally:
+                renderer.tw_collected = None
+
+            renderer.tw_filled = dict(zip(items,
+                                          renderer.tw_fill_many(items)))
+            try:
+                outs = [[self._render(list(tokens), ctx) for ctx in ctxs]
+                        for tokens in batch]
+            finally:
+                renderer.tw_filled = None
+
+            yield from outs
+
+    def _wrap_blocks(self, text, pos=0, footnotes=(), line=0):
+        """Wrap text from pos on, one top-level block at a time.
+
+        footnotes are the keys of footnotes defined before pos; line
+        is the line at pos.  Yields the blocks; see wrap_blocks.
+        """
+        self.block.def_footnotes = dict.fromkeys(footnotes, 0)
+
+        lines = (m.group(0) for m in _line_pattern.finditer(text, pos))
+        chunks = map(mistune.preprocessing, _iter_chunks(lines))
+        source_lines = _source_line_pattern.finditer(text, pos)
+
+        block = None
+        start = pos
+        for source, tokens, closers in self.block.parse_chunks(chunks):
+            end = start
+            end_line = line + source.count('\n')
+            for i in range(line, end_line):
+                end = next(source_lines).end()
+            # The last line of the document may not end with a newline.
+            end += len(source) - (source.rfind('\n') + 1)
+
+            footnotes = [t.key for t in tokens
+                         if t.type == 'footnote_start']
+            # Closers found after the block may be edited away, and
+            # the block is not at the end of the document for good.
+            closers = self.block._closers(source + '\0', 0, len(source),
+                                          tokens)
+
+            block = {
+                'start': start,
+                'end': end,
+                'start_line': line,
+                'end_line': end_line,
+                'footnotes': footnotes,
+                'closers': closers,
+                'wrapped': self._render(tokens),
+            }
+            yield block
+            start = end
+            line = end_line
+
+        if block:
+            # Trailing newlines are not part of the last block's source.
+            block['end'] = len(text)
+            block['end_line'] += sum(1 for m in source_lines)
+
+    def wrap_blocks(self, text):
+        """Wrap text one top-level block at a time.
+
+        Returns a list of blocks.  A block is a dict with the 'start'
+        and 'end' offsets of the block in text, the 'start_line' and
+        'end_line' of its lines, counted from 0, and its 'wrapped'
+        output; join_blocks joins the wrapped output of the blocks.
+        The blocks can be given to rewrap along with an edit of text.
+        """
+        try:
+            return list(self._wrap_blocks(text))
+        finally:
+            # reset block
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+
+    def join_blocks(self, blocks):
+        """Join the output of wrap_blocks; same as the output of parse.
+        """
+        return ''.join(self._clean_stream(b['wrapped'] for b in blocks))
+
+    def rewrap(self, text, blocks, start, end, replacement):
+        """Wrap text again after replacing text[start:end].
+
+        blocks are the blocks of text from wrap_blocks or rewrap.  Only
+        the top-level blocks the edit touches are lexed and rendered
+        again; the others are reused.  Returns the edited text and its
+        blocks.
+        """
+        new_text = text[:start] + replacement + text[end:]
+        delta = len(new_text) - len(text)
+        if not blocks:
+            return new_text, self.wrap_blocks(new_text)
+
+        # Start with the block before the edited block, as the edit
+        # may join them.
+        lo, hi = 0, len(blocks)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if blocks[mid]['start'] <= start:
+                lo = mid
+            else:
+                hi = mid
+        first = max(lo - 1, 0)
+        while not _is_chunk_start(text, blocks[first]['start']):
+            first -= 1
+
+        # Lines around the edit, from the line before it on, before
+        # and after the edit.
+        edit_start = max(text.rfind('\n', 0, max(text.rfind('\n', 0, start),
+                                                 0)), 0)
+        edit_end = text.find('\n', end)
+        edits = [text[edit_start:edit_end if edit_end >= 0 else None]]
+        edit_end = new_text.find('\n', start + len(replacement))
+        edits.append(new_text[edit_start:edit_end if edit_end >= 0 else None])
+        edits = [mistune.preprocessing(e) for e in edits]
+
+        footnotes = []
+        for i, block in enumerate(blocks[:first]):
+            if any(c.search(e) for c in block['closers'] for e in edits):
+                # The edit may make another block out of this block.
+                first = i
+                break
+            footnotes.extend(block['footnotes'])
+
+        pos = blocks[first]['start']
+        new_blocks = blocks[:first]
+        old_footnotes = []
+        new_footnotes = []
+        k = first
+        try:
+            line = blocks[first]['start_line']
+            for block in self._wrap_blocks(new_text, pos, footnotes, line):
+                new_blocks.append(block)
+                new_footnotes.extend(block['footnotes'])
+
+                # Look for an unchanged block that starts where this
+                # block ends.
+                while (k < len(blocks)
+                       and (blocks[k]['start'] < end
+                            or blocks[k]['start'] + delta < block['end'])):
+                    old_footnotes.extend(blocks[k]['footnotes'])
+                    k += 1
+
+                if (k < len(blocks)
+                    and blocks[k]['start'] + delta == block['end']
+                    and block['end'] >= start + len(replacement)
+                    and old_footnotes == new_footnotes
+                    and _is_chunk_start(new_text, block['end'])):
+                    lines = block['end_line'] - blocks[k]['start_line']
+                    for b in blocks[k:]:
+                        new_blocks.append(dict(
+                            b, start=b['start'] + delta,
+                            end=b['end'] + delta,
+                            start_line=b['start_line'] + lines,
+                            end_line=b['end_line'] + lines))
+                    break
+        finally:
+            # reset block
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+
+        return new_text, new_blocks
+
+    def _range_start(self, text, line):
+        """Find the line to lex text from, to wrap the top-level block
+        on line.
+
+        text is preprocessed by mistune.preprocessing, which keeps its
+        lines.  The chunks before line are gone through as
+        TWBlockLexer.parse_chunks does, but only those that may hold
+        a fence, an HTML block or a definition are lexed.  Returns the
+        first line of the last chunk, up to line, that starts a
+        top-level block, and the keys of the footnotes defined before.
+        """
+        start = 0
+        keys = []
+        found = 0
+        closers = []
+        carry = ''
+        pos = 0
+        for chunk in _iter_text_chunks(text):
+            if pos > line:
+                break
+
+            if not closers:
+                start, found = pos, len(keys)
+                if not (_footnote_def_pattern.search(chunk)
+                        or self.block._closers(chunk, 0, len(chunk), None)):
+                    # No block of chunk spans chunks or defines
+                    # footnotes.
+                    pos += chunk.count('\n')
+                    continue
+            elif not any(c.search(chunk) for c in closers):
+                carry += chunk
+                pos += chunk.count('\n')
+                continue
+
+            chunk_text = carry + chunk
+            lexed = 0
+            closers = []
+            for source, tokens, closers in self.block._parse_text(chunk_text):
+                if closers:
+                    break
+                lexed += len(source)
+                keys.extend(t.key for t in tokens
+                            if t.type == 'footnote_start')
+            carry = chunk_text[lexed:] if closers else ''
+            pos += chunk.count('\n')
+
+        return start, keys[:found]
+
+    def wrap_range(self, text, start_line, end_line):
+        """Wrap the top-level blocks on lines start_line to end_line
+        of text.
+
+        Lines are counted from 0 and end_line is left out; an empty
+        range is the block on start_line.  Only the blocks of the range
+        are lexed and rendered.  Returns a block, as wrap_blocks does,
+        that spans the blocks of the range; its 'wrapped' output takes
+        the place of its lines in the output of parse.
+        """
+        lines = list(itertools.islice(
+            _source_line_pattern.finditer(text), start_line + 1))
+        start_line = min(start_line, len(lines) - 1)
+        end_line = max(end_line, start_line + 1)
+
+        blocks = []
+        block = None
+        if lines:
+            # Lines after start_line are not needed to find where to
+            # start.
+            line, footnotes = self._range_start(
+                mistune.preprocessing(text[:lines[-1].end()]), start_line)
+            try:
+                for block in self._wrap_blocks(text, lines[line].start(),
+                                               footnotes, line):
+                    if block['end_line'] > start_line:
+                        blocks.append(block)
+                    # The last block of text takes in the lines after
+                    # it once _wrap_blocks is done.
+                    if (block['end_line'] >= end_line
+                        and text[block['end']:].strip(' \t\r\n\u2424')):
+                        break
+            finally:
+                # reset block
+                self.block.def_links = {}
+                self.block.def_footnotes = {}
+
+        if not blocks:
+            if not block:
+                return {'start': 0, 'end': len(text), 'start_line': 0,
+                        'end_line': len(lines), 'wrapped': '\n'}
+            # The range is within the lines after the last block.
+            blocks.append(block)
+
+        wrapped = ''.join(b['wrapped'] for b in blocks)
+        wrapped = '\n'.join(l.rstrip() for l in wrapped.split('\n'))
+        # Same as _clean_stream, at the start and end of text.
+        if blocks[0]['start'] == 0:
+            wrapped = wrapped.lstrip('\n')
+        if blocks[-1]['end'] == len(text):
+            wrapped = wrapped.rstrip('\n') + '\n'
+
+        return {
+            'start': blocks[0]['start'],
+            'end': blocks[-1]['end'],
+            'start_line': blocks[0]['start_line'],
+            'end_line': blocks[-1]['end_line'],
+            'wrapped': wrapped,
+        }
+
+    def check(self, text):
+        """Tell if text is wrapped, that is, the same as the output of
+        parse.
+
+        The output is compared with text as it is rendered, and
+        rendering stops at the first block that differs.
+        """
+        lines = (m.group(0) for m in _line_pattern.finditer(text))
+        outs = self.parse_stream(lines)
+
+        pos = 0
+        try:
+            for out in outs:
+                if not text.startswith(out, pos):
+                    return False
+                pos += len(out)
+        finally:
+            outs.close()
+
+        return pos == len(text)
+
+    def diff(self, text, path='', n=3):
+        """Unified diff of text and its wrapped output, as lines.
+
+        Source blocks are diffed with their rendered output one block
+        at a time, and difflib runs only on the blocks that differ;
+        the changes are then grouped into hunks, with n lines of
+        context, as difflib.unified_diff does for the whole text.
+        path names the document in the diff's header.
+        """
+        import difflib
+
+        def _range(start, length):
+            # from difflib
+            if length == 1:
+                return '{}'.format(start + 1)
+            if not length:
+                return '{},0'.format(start)
+            return '{},{}'.format(start + 1, length)
+
+        def _lines(tag, lines):
+            for line in lines:
+                if line.endswith('\n'):
+                    yield tag + line
+                else:
+                    yield tag + line + '\n'
+                    yield '\\ No newline at end of file\n'
+
+        header = ['--- {}\n'.format(path), '+++ {}\n'.format(path)]
+        src_pos = out_pos = 0
+        hunk = None  # source start, output start and lines of open hunk
+        # First and last n of the lines left alone since the last
+        # change, and their number.
+        head = []
+        tail = collections.deque(maxlen=n)
+        equal = 0
+
+        def close():
+            nonlocal header, hunk
+
+            src_start, out_start, body = hunk
+            body.append((' ', head))
+            yield from header
+            header = []
+            yield '@@ -{} +{} @@\n'.format(
+                _range(src_start, sum(len(l) for t, l in body if t != '+')),
+                _range(out_start, sum(len(l) for t, l in body if t != '-'))
+            )
+            for tag, lines in body:
+                yield from _lines(tag, lines)
+            hunk = None
+
+        def keep(lines):
+            nonlocal src_pos, out_pos, equal
+
+            head.extend(lines[:n - len(head)])
+            tail.extend(lines)
+            equal += len(lines)
+            src_pos += len(lines)
+            out_pos += len(lines)
+
+        def change(src, out):
+            nonlocal src_pos, out_pos, hunk, head, equal
+
+            if hunk and equal > 2 * n:
+                yield from close()
+            if hunk:
+                # Lines left alone between two changes are all context.
+                rest = equal - len(head)
+                hunk[2].append((' ', head + list(tail)[len(tail) - rest:]))
+            else:
+                hunk = [src_pos - len(tail), out_pos - len(tail),
+                        [(' ', list(tail))]]
+            hunk[2].append(('-', src))
+            hunk[2].append(('+', out))
+
+            head = []
+            tail.clear()
+            equal = 0
+            src_pos += len(src)
+            out_pos += len(out)
+
+        def compare(blocks):
+            for src, out in blocks:
+                if src == out:
+                    keep(src)
+                    continue
+                matcher = difflib.SequenceMatcher(None, src, out, False)
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                    if tag == 'equal':
+                        keep(src[i1:i2])
+                    else:
+                        yield from change(src[i1:i2], out[j1:j2])
+
+        # Source and output lines of the blocks not diffed yet.  An
+        # output line belongs to the block it starts in.  Blank output
+        # lines are kept only if more output follows them, see
+        # _clean_stream, so a block is diffed once its lines are done
+        # and the blank lines it ends with are known to be kept.
+        pending = []
+        blank = None  # block of the first blank line not known to be kept
+        owner = None  # block of the line not done yet
+        started = False
+        line = ''
+
+        try:
+            blocks = self._wrap_blocks(text)
+            block = next(blocks, None)
+            while block:
+                # The end of the last block is set after it is yielded.
+                next_block = next(blocks, None)
+
+                src = _line_pattern.findall(text[block['start']:block['end']])
+                pending.append((src, []))
+                k = len(pending) - 1
+                if owner is None:
+                    owner = k
+
+                lines = (line + block['wrapped']).split('\n')
+                line = lines.pop()
+                for l in lines:
+                    l = l.rstrip()
+                    if l:
+                        blank = None
+                        started = True
+                    elif not started:
+                        owner = k
+                        continue
+                    elif blank is None:
+                        blank = owner
+                    pending[owner][1].append(l + '\n')
+                    owner = k
+                if not line:
+                    owner = None
+
+                done = min(i for i in (blank, owner, len(pending))
+                           if i is not None)
+                yield from compare(pending[:done])
+                pending = pending[done:]
+                if blank is not None:
+                    blank -= done
+                if owner is not None:
+                    owner -= done
+
+                block = next_block
+        finally:
+            # reset block
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+
+        line = line.rstrip()
+        if line:
+            pending[owner][1].append(line + '\n')
+            started = True
+        elif blank is not None:
+            # Blank lines at the end are dropped.
+            for src, out in pending[blank:]:
+                while out and out[-1] == '\n':
+                    out.pop()
+        if not started:
+            if not pending:
+                # No block covers text when it only has blank lines.
+                src = [] if src_pos else _line_pattern.findall(text)
+                pending.append((src, []))
+            pending[-1][1].append('\n')
+        yield from compare(pending)
+        if hunk:
+            yield from close()
+
+    def parse_widths(self, text, widths):
+        """Wrap text at each of widths.
+
+        text is lexed once; each top-level block is rendered at all
+        widths before the next block is lexed.  Returns the wrapped
+        text for each width, in the order of widths.
+        """
+        ctx = self.renderer.context()
+        ctxs = [ctx._replace(width=width) for width in widths]
+        outs = [[] for width in widths]
+
+        text = mistune.preprocessing(text)
+        chunks = _iter_text_chunks(text)
+        try:
+            self.inline.setup(self.block.def_links,
+                              self.block.def_footnotes)
+            blocks = self._lex_chunks(chunks)
+            if self.renderer.tw_batches():
+                blocks = self._render_batches(blocks, ctxs)
+            else:
+                # Rendering uses up the list of tokens.
+                blocks = ([self._render(list(tokens), ctx) for ctx in ctxs]
+                          for tokens in blocks)
+
+            for rendered in blocks:
+                for out, block in zip(outs, rendered):
+                    out.append(block)
+        finally:
+            # reset block
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+
+        return [''.join(self._clean_stream(out)) for out in outs]
+
+    def parse_stream(self, lines):
+        """Wrap a document one top-level block at a time.
+
+        lines is an iterable of lines, e.g. a file object; they are
+        read as they are needed.  Yields the wrapped output; the
+        joined output is the same as the output of parse.
+        """
+        chunks = map(mistune.preprocessing, _iter_chunks(lines))
 
-        # Remove trailing spaces from all lines.
-        out = self._clean_ts(out)
+        return self._parse_chunks(chunks)
 
-        # Add newline at the end.
-        return '{}\n'.format(out.strip('\n'))
+    def _lex_chunks(self, chunks):
+        """Lex preprocessed chunks; yields the tokens of each top-level
+        block.
 
-    def _add_prefix(self, prefix, initial=True, subseq=True):
-        p = self.renderer.tw_get('initial_indent') + prefix
+        With a token cache, the chunks are all read first; the tokens
+        are loaded from the cache if the document was lexed before, and
+        saved to it otherwise.
+        """
+        cache = self.token_cache
+        if cache is None:
+            for source, tokens, closers in self.block.parse_chunks(chunks):
+                yield tokens
+            return
 
-        if initial:
-            self.renderer.tw_set(initial_indent=p)
-        if subseq:
-            self.renderer.tw_set(subsequent_indent=p)
+        chunks = list(chunks)
+        key = cache.key(chunks)
+        blocks = cache.load(key)
+        if blocks is not None:
+            yield from blocks
+            return
+
+        blocks = []
+        for source, tokens, closers in self.block.parse_chunks(chunks):
+            # Rendering uses up the list of tokens.
+            blocks.append(list(tokens))
+            yield tokens
+        cache.save(key, blocks)
+
+    def _parse_chunks(self, chunks):
+        """Lex and render preprocessed chunks; see parse_stream."""
+        def blocks():
+            self.inline.setup(self.block.def_links,
+                              self.block.def_footnotes)
+
+            blocks = self._lex_chunks(chunks)
+            if self.renderer.tw_batches():
+                for rendered in self._render_batches(blocks):
+                    yield rendered[0]
+                return
+
+            for tokens in blocks:
+                yield self._render(tokens)
+
+        try:
+            yield from self._clean_stream(blocks())
+        finally:
+            # reset block
+            self.block.def_links = {}
+            self.block.def_footnotes = {}
+
+    # from mistune
+    def tok(self, ctx=None):
+        # ctx is None when called by mistune.Markdown.output.
+        ctx = ctx or self.renderer.context()
+        t = self.token.type
 
-    def _remove_prefix(self, length, initial=True, subseq=True):
-        p = self.renderer.tw_get('initial_indent')[:-length]
+        # sepcial cases
+        if t.endswith('_start'):
+            t = t[:-6]
 
-        if initial:
-            self.renderer.tw_set(initial_indent=p)
-        if subseq:
-            self.renderer.tw_set(subsequent_indent=p)
+        return getattr(self, 'output_%s' % t)(ctx)
 
-    def output_heading(self):
+    # from mistune
+    def tok_text(self):
+        text = self.token.text
+        while self.peek().type == 'text':
+            text += '\n' + self.pop().text
+        return self.inline(text)
+
+    # from mistune
+    def output_newline(self, ctx):
+        return self.renderer.newline()
+
+    def output_table(self, ctx):
+        return super(TWMarkdown, self).output_table()
+
+    # from mistune
+    def output_text(self, ctx):
+        return self.renderer.paragraph(self.tok_text(), ctx)
+
+    # from mistune
+    def output_code(self, ctx):
+        return self.renderer.block_code(self.token.text, self.token.lang,
+                                        ctx)
+
+    # from mistune
+    def output_paragraph(self, ctx):
+        return self.renderer.paragraph(self.inline(self.token.text), ctx)
+
+    # from mistune
+    def output_list(self, ctx):
+        ordered = self.token.ordered
+        body = []
+        while self.pop().type != 'list_end':
+            body.append(self.tok(ctx))
+        return self.renderer.list(''.join(body), ordered)
+
+    def output_heading(self, ctx):
         rendered_heading = '{}{}'.format(
-            self.renderer.tw_get('initial_indent'),
-            super(TWMarkdown, self).output_heading()
+            ctx.initial_indent,
+            # from mistune
+            self.renderer.header(self.inline(self.token.text),
+                                 self.token.level, self.token.text)
         )
 
         return rendered_heading
 
-    def output_block_quote(self):
+    def output_block_quote(self, ctx):
         # Add prefix
-        self._add_prefix('> ')
+        ctx = ctx.indent('> ')
 
         def process():
-            if self.token['type'] == 'text':
-                txt = self.renderer.tw_fill(self.tok_text())
+            if self.token.type == 'text':
+                txt = self.renderer.tw_fill(self.tok_text(), ctx)
             else:
                 # Append subsequent indent.
                 txt = ''.join([
-                    self.tok().rstrip(),
+                    self.tok(ctx).rstrip(),
                     '\n',
-                    self.renderer.tw_get('subsequent_indent'),
+                    ctx.subsequent_indent,
                     '\n'
                 ])
 
             return txt
 
-        body = self.renderer.placeholder()
-        while self.pop()['type'] != 'block_quote_end':
-            body += process()
+        body = []
+        while self.pop().type != 'block_quote_end':
+            body.append(process())
 
         # Remove last trailing subsequent indent.
-        body = body.rstrip(
-            self.renderer.tw_get('subsequent_indent') +
-            '\n'
-        )
+        body = ''.join(body).rstrip(ctx.subsequent_indent + '\n')
 
         # Render block quote
         rendered_bq = self.renderer.block_quote(body)
 
-        # Remove prefix
-        self._remove_prefix(len('> '))
-
         return rendered_bq
 
-    def output_block_html(self):
-        text = self.token['text']
-        return self.renderer.block_html(text)
+    def output_block_html(self, ctx):
+        text = self.token.text
+        return self.renderer.block_html(text, ctx)
 
-    def output_list_item(self):
+    def output_list_item(self, ctx):
         rm_i_indent = True # Remove initial indent.
-        indent = ''.ljust(self.token['spaces'])
+        indent = ''.ljust(self.token.spaces)
+
+        # Add bullet
+        body = [ctx.initial_indent, self.token.text]
+
+        # Set width and prefix
+        item_ctx = ctx.indent(indent,
+                              width=ctx.width - len(ctx.initial_indent))
 
         def process():
             nonlocal rm_i_indent
 
             txt = ''
-            if self.token['type'] == 'text':
-                txt = self.renderer.tw_fill(self.tok_text())
+            if self.token.type == 'text':
+                txt = self.renderer.tw_fill(self.tok_text(), item_ctx)
             else:
-                txt = '\n' + self.tok()
+                txt = '\n' + self.tok(item_ctx)
 
             if rm_i_indent:
-                txt = txt.lstrip(self.renderer.tw_get('initial_indent'))
+                txt = txt.lstrip(item_ctx.initial_indent)
 
                 # Don't remove initial indent after processing first item.
                 rm_i_indent = False
 
             return txt
 
-        # Add bullet
-        body = self.renderer.tw_get('initial_indent') + self.token['text']
-
-        # Set width
-        o_width = self.renderer.tw_get('width')
-        item_width = (o_width
-                          - len(self.renderer.tw_get('initial_indent')))
-        self.renderer.tw_set(width=item_width)
-
-        # Set prefix
-        prefix = self._add_prefix(indent)
-
         # Process list item
-        while self.pop()['type'] != 'list_item_end':
-            body += process()
-        body = body.rstrip()
+        while self.pop().type != 'list_item_end':
+            body.append(process())
+        body = ''.join(body).rstrip()
 
         # Render list item
         rendered_li = self.renderer.list_item(body)
 
-        # Remove prefix
-        self._remove_prefix(len(indent))
-
-        # Revert width
-        self.renderer.tw_set(width=o_width)
-
         return rendered_li
 
-    def output_loose_item(self):
+    def output_loose_item(self, ctx):
         rm_i_indent = True # Remove initial indent.
-        indent = ''.ljust(self.token['spaces'])
+        indent = ''.ljust(self.token.spaces)
+
+        # Add bullet
+        body = [ctx.initial_indent, self.token.text]
+
+        # Set width and prefix
+        item_ctx = ctx.indent(indent,
+                              width=ctx.width - len(ctx.initial_indent))
 
         def process():
             nonlocal rm_i_indent
 
-            txt = self.tok()
+            txt = self.tok(item_ctx)
             if rm_i_indent:
-                txt = txt.lstrip(self.renderer.tw_get('initial_indent'))
+                txt = txt.lstrip(item_ctx.initial_indent)
 
                 # Don't remove initial indent after processing first item.
                 rm_i_indent = False
 
             return txt
 
-        # Add bullet
-        body = self.renderer.tw_get('initial_indent') + self.token['text']
-
-        # Set width
-        o_width = self.renderer.tw_get('width')
-        item_width = (o_width
-                          - len(self.renderer.tw_get('initial_indent')))
-        self.renderer.tw_set(width=item_width)
-
-        # Set prefix
-        prefix = self._add_prefix(indent)
-
-        while self.pop()['type'] != 'list_item_end':
-            body += process()
-        body = body.rstrip() + '\n'
+        while self.pop().type != 'list_item_end':
+            body.append(process())
+        body = ''.join(body).rstrip() + '\n'
 
         rendered_li = self.renderer.list_item(body)
 
-        # Remove prefix
-        self._remove_prefix(len(indent))
-
-        # Revert width
-        self.renderer.tw_set(width=o_width)
-
         return rendered_li
 
-    def output_hrule(self):
-        return self.renderer.hrule(self.token['text'])
+    def output_hrule(self, ctx):
+        return self.renderer.hrule(self.token.text)
 
-    def output_def_link(self):
-        return self.renderer.def_link(self.token['text'])
+    def output_def_link(self, ctx):
+        return self.renderer.def_link(self.token.text)
 
-    def output_footnote(self):
+    def output_footnote(self, ctx):
         rm_i_indent = True
-        indent = ''.ljust(self.token['spaces'])
+        indent = ''.ljust(self.token.spaces)
+
+        # Take note of footnote key.
+        key = self.token.key
+
+        # Add current initial indent
+        body = [ctx.initial_indent]
+
+        # Set width and prefix
+        item_ctx = ctx.indent(indent,
+                              width=(ctx.width
+                                     - (len(ctx.initial_indent)
+                                        # Account for '[^key]: '
+                                        + (len(key) + 5))))
 
         def process():
             nonlocal rm_i_indent
 
-            txt = self.tok()
+            txt = self.tok(item_ctx)
             if rm_i_indent:
                 txt = txt.lstrip()
 
@@ -517,67 +2366,853 @@ class TWMarkdown(mistune.Markdown):
 
             return txt
 
-        # Take note of footnote key.
-        key = self.token['key']
+        while self.pop().type != 'footnote_end':
+            body.append(process())
+        body = ''.join(body).rstrip() + '\n'
 
-        # Add current initial indent
-        body = self.renderer.tw_get('initial_indent')
+        rendered_fn = self.renderer.footnote_item(key, body)
 
-        # Set width
-        o_width = self.renderer.tw_get('width')
-        item_width = (o_width
-                          - (len(self.renderer.tw_get('initial_indent'))
-                                 # Account for '[^key]: '
-                                 + (len(key) + 5)))
-        self.renderer.tw_set(width=item_width)
+        return rendered_fn
 
-        # Set prefix
-        prefix =  self._add_prefix(indent)
 
-        while self.pop()['type'] != 'footnote_end':
-            body += process()
-        body = body.rstrip() + '\n'
+# Extensions of the Markdown files looked up in directories.
+_md_extensions = ('.md', '.markdown')
 
-        rendered_fn = self.renderer.footnote_item(key, body)
+# State of the process running _wrap_file and _rewrite_file.
+_worker_md = None
+_worker_kwargs = {}
+_worker_cache = frozenset()
 
-        # Remove prefix
-        self._remove_prefix(len(indent))
 
-        # Revert width
-        self.renderer.tw_set(width=o_width)
+class TWCache(object):
+    """Keys of documents known to be wrapped.
+
+    A key is the hash of the document, the TWMarkdown options and the
+    version of markdown-textwrap.  Keys are kept in a file, one per
+    line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = set()
+        self.new_keys = set()
+
+        try:
+            with open(path) as f:
+                self.keys.update(f.read().split())
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def key(text, options):
+        import hashlib
+
+        h = hashlib.sha256()
+        h.update('{}\0{}\0'.format(__version__,
+                                     sorted(options.items())).encode())
+        h.update(text.encode('utf-8', 'surrogateescape'))
+
+        return h.hexdigest()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        if key not in self.keys:
+            self.keys.add(key)
+            self.new_keys.add(key)
+
+    def save(self):
+        if not self.new_keys:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(''.join(k + '\n' for k in sorted(self.new_keys)))
+        self.new_keys = set()
+
+
+class TWTokenCache(object):
+    """Tokens of lexed documents, kept in files under path.
+
+    The tokens of a document do not depend on the TWMarkdown options;
+    they are kept as zlib compressed JSON, in a file named after the
+    hash of the preprocessed document and the version of
+    markdown-textwrap.  Files may be removed at any time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key(chunks):
+        import hashlib
+
+        h = hashlib.sha256()
+        h.update('{}\0'.format(__version__).encode())
+        for chunk in chunks:
+            h.update(chunk.encode('utf-8', 'surrogateescape'))
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    @staticmethod
+    def _dump_token(token):
+        i = _token_classes.index(type(token))
+        return [i] + [getattr(token, f) for f in _token_fields[i]]
+
+    @staticmethod
+    def _load_token(data):
+        cls = _token_classes[data[0]]
+        token = cls.__new__(cls)
+        for f, value in zip(_token_fields[data[0]], data[1:]):
+            setattr(token, f, value)
+
+        return token
+
+    def load(self, key):
+        """Tokens of the top-level blocks of the document of key; None
+        if they are not kept.
+        """
+        import json
+        import zlib
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()))
+
+            return [[self._load_token(t) for t in block] for block in data]
+        except (OSError, LookupError, TypeError, ValueError, zlib.error):
+            return None
+
+    def save(self, key, blocks):
+        """Keep blocks, the tokens of the top-level blocks of the
+        document of key.
+        """
+        import json
+        import zlib
+
+        data = json.dumps([[self._dump_token(t) for t in block]
+                           for block in blocks], separators=(',', ':'))
+        path = self._path(key)
+        # Other processes and threads never see a partly written file.
+        tmp_path = '{}.{}-{}'.format(path, os.getpid(),
+                                     threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(data.encode('utf-8'), 1))
+            os.replace(tmp_path, path)
+        except OSError:
+            # Documents are wrapped all the same.
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def _cache_path():
+    cache_home = (os.environ.get('XDG_CACHE_HOME')
+                  or os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(cache_home, 'md-tw', 'wrapped')
+
+
+def _iter_md_files(paths):
+    """Expand directories in paths into the Markdown files in them.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                if f.endswith(_md_extensions):
+                    yield os.path.join(root, f)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def mmap_lines(path, window=1 << 20, encoding=None):
+    """Read the lines of the file at path through a memory map.
+
+    The file is decoded window bytes at a time, cut at line ends, so
+    only a window of it is held as text; pages already read are given
+    back to the OS page cache.  encoding defaults to the one open
+    uses.  The lines can be given to TWMarkdown.parse_stream.
+    """
+    import locale
+
+    encoding = encoding or locale.getpreferredencoding(False)
+
+    # Open the file now, so that errors show up here.
+    return _iter_mmap_lines(open(path, 'rb'), window, encoding)
+
+
+def _iter_mmap_lines(f, window, encoding):
+    import mmap
+
+    with f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = dropped = 0
+            while start < len(mm):
+                end = mm.rfind(b'\n', start, start + window) + 1
+                if end <= start:
+                    # A line longer than window.
+                    end = mm.find(b'\n', start + window) + 1 or len(mm)
+
+                yield from _line_pattern.findall(
+                    mm[start:end].decode(encoding)
+                )
+
+                # Drop the pages read from the process.
+                done = end - end % mmap.PAGESIZE
+                if done > dropped and hasattr(mmap, 'MADV_DONTNEED'):
+                    mm.madvise(mmap.MADV_DONTNEED, dropped, done - dropped)
+                    dropped = done
+                start = end
+
+
+def _init_worker(kwargs, cache=frozenset(), stats=False):
+    global _worker_md, _worker_kwargs, _worker_cache
+
+    _worker_kwargs = kwargs
+    _worker_cache = cache
+    _worker_md = TWMarkdown(tw_stats=TWStats() if stats else None, **kwargs)
 
-        return rendered_fn
+
+def _worker_error(e):
+    global _worker_md
+
+    # Don't reuse an instance that failed half way through a
+    # document.
+    _worker_md = TWMarkdown(tw_stats=_worker_md.stats, **_worker_kwargs)
+
+    return getattr(e, 'strerror', None) or str(e)
+
+
+def _wrap_file(path, use_mmap=False):
+    try:
+        if path == '-':
+            return ''.join(_worker_md.parse_stream(sys.stdin)), None
+
+        if use_mmap:
+            return ''.join(_worker_md.parse_stream(mmap_lines(path))), None
+
+        with open(path) as f:
+            return ''.join(_worker_md.parse_stream(f)), None
+    except Exception as e:
+        return None, _worker_error(e)
+
+
+def _replace_file(path, text):
+    """Replace the contents of the file at path with text.
+
+    text is written to a file next to it, which then takes its place,
+    so that an interrupted md-tw never leaves the file partly written.
+    The file keeps its mode.
+    """
+    import stat
+    import tempfile
+
+    path = os.path.realpath(path)
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    f = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                    prefix='.md-tw-', delete=False)
+    try:
+        with f:
+            f.write(text)
+        os.chmod(f.name, mode)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def _rewrite_file(path):
+    try:
+        with open(path) as f:
+            text = f.read()
+
+        key = TWCache.key(text, _worker_md.options)
+        if key in _worker_cache:
+            return False, None, None
+
+        wrapped = ''.join(
+            _worker_md.parse_stream(_line_pattern.findall(text))
+        )
+        if wrapped == text:
+            return False, key, None
+
+        _replace_file(path, wrapped)
+
+        return True, None, None
+    except Exception as e:
+        return None, None, _worker_error(e)
+
+
+def _check_file(path):
+    try:
+        if path == '-':
+            text = sys.stdin.read()
+        else:
+            with open(path) as f:
+                text = f.read()
+
+        key = TWCache.key(text, _worker_md.options)
+        if key in _worker_cache:
+            return True, None, None
+        if not _worker_md.check(text):
+            return False, None, None
+
+        return True, key, None
+    except Exception as e:
+        return None, None, _worker_error(e)
+
+
+def _diff_file(path):
+    try:
+        if path == '-':
+            text = sys.stdin.read()
+        else:
+            with open(path) as f:
+                text = f.read()
+
+        return ''.join(_worker_md.diff(text, path)), None
+    except Exception as e:
+        return None, _worker_error(e)
+
+
+def _out_path(template, path, width):
+    """Path of the file that path wrapped at width is written to."""
+    if path == '-':
+        dir_, stem, ext = '.', 'stdin', ''
+    else:
+        dir_, name = os.path.split(path)
+        stem, ext = os.path.splitext(name)
+
+    return template.format(dir=dir_ or '.', stem=stem, ext=ext, width=width)
+
+
+def _write_wrapped_file(path, widths, template):
+    try:
+        if path == '-':
+            text = sys.stdin.read()
+        else:
+            with open(path) as f:
+                text = f.read()
+
+        wrapped = _worker_md.parse_widths(text, widths)
+    except Exception as e:
+        return None, _worker_error(e)
+
+    out_paths = []
+    for width, text in zip(widths, wrapped):
+        out_path = _out_path(template, path, width)
+        try:
+            out_dir = os.path.dirname(out_path)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            with open(out_path, 'w') as f:
+                f.write(text)
+        except OSError as e:
+            return out_paths, '{}: {}'.format(out_path, e.strerror)
+        out_paths.append(out_path)
+
+    return out_paths, None
+
+
+def _render_part(part):
+    text, last = part
+    result = _worker_md._render_part(text, last=last)
+
+    stats = _worker_md.stats
+    return result, stats.flush() if stats is not None else None
+
+
+def _run_job(job):
+    i, func, path = job
+    result = func(path)
+
+    stats = _worker_md.stats
+    return i, result, stats.flush() if stats is not None else None
+
+
+def _map_files(func, paths, jobs, kwargs, cache=frozenset(), stats=None):
+    """Run func on paths, in jobs worker processes.
+
+    Files are handed out to the workers biggest first.  Yields (path,
+    result) in the order of paths.  The timings of the workers are
+    merged into stats, a TWStats, if given.
+    """
+    tasks = [(i, func, path) for i, path in enumerate(paths)]
+
+    def run(results):
+        for i, result, timings in results:
+            if timings:
+                stats.merge(timings)
+            yield i, result
+
+    # Files read from stdin are done here; others in the pool.
+    init_args = (kwargs, cache, stats is not None)
+    _init_worker(*init_args)
+    pending = dict(run(map(_run_job, (t for t in tasks if t[2] == '-'))))
+    tasks = [t for t in tasks if t[2] != '-']
+
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(min(jobs, len(tasks)),
+                                    _init_worker, init_args)
+        tasks.sort(key=lambda t: _file_size(t[2]), reverse=True)
+        results = run(pool.imap_unordered(_run_job, tasks))
+    else:
+        results = run(map(_run_job, tasks))
+
+    n = 0
+    try:
+        while n < len(paths):
+            if n not in pending:
+                i, result = next(results)
+                pending[i] = result
+                continue
+
+            yield paths[n], pending.pop(n)
+            n += 1
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def wrap_files(paths, jobs=1, stats=None, use_mmap=False, **kwargs):
+    """Wrap Markdown files.
+
+    Directories in paths are searched for Markdown files.  Files are
+    spread over jobs worker processes, biggest files first, each worker
+    using one TWMarkdown instance created with kwargs.  Yields (path,
+    wrapped text, error) in the order of paths; error is None or a
+    message telling why the file could not be wrapped.  stats is an
+    optional TWStats the timings of the workers are recorded in.
+    Files are read with mmap_lines if use_mmap is true.
+    """
+    paths = list(_iter_md_files(paths))
+
+    func = functools.partial(_wrap_file, use_mmap=use_mmap)
+    docs = _map_files(func, paths, jobs, kwargs, stats=stats)
+    for path, (text, error) in docs:
+        yield path, text, error
+
+
+def rewrite_files(paths, jobs=1, cache=None, stats=None, **kwargs):
+    """Wrap Markdown files in place.
+
+    Like wrap_files, but only files whose wrapped text differs are
+    written back.  cache is an optional TWCache; files it knows to be
+    wrapped are skipped without being parsed.  Yields (path, changed,
+    error).
+    """
+    paths = list(_iter_md_files(paths))
+    keys = frozenset(cache.keys) if cache else frozenset()
+
+    docs = _map_files(_rewrite_file, paths, jobs, kwargs, keys, stats)
+    for path, (changed, key, error) in docs:
+        if cache and key:
+            cache.add(key)
+        yield path, changed, error
+
+    if cache:
+        cache.save()
+
+
+def check_files(paths, jobs=1, cache=None, stats=None, **kwargs):
+    """Tell which Markdown files are wrapped.
+
+    Like rewrite_files, but nothing is written; a file stops being
+    wrapped at the first block that differs, see TWMarkdown.check.
+    Yields (path, wrapped, error).
+    """
+    paths = list(_iter_md_files(paths))
+    keys = frozenset(cache.keys) if cache else frozenset()
+
+    docs = _map_files(_check_file, paths, jobs, kwargs, keys, stats)
+    for path, (wrapped, key, error) in docs:
+        if cache and key:
+            cache.add(key)
+        yield path, wrapped, error
+
+    if cache:
+        cache.save()
+
+
+def diff_files(paths, jobs=1, stats=None, **kwargs):
+    """Diff Markdown files with their wrapped text.
+
+    Like wrap_files, but yields (path, diff, error); diff is the
+    unified diff of the file and its wrapped text, see TWMarkdown.diff,
+    and is empty if the file is wrapped.
+    """
+    paths = list(_iter_md_files(paths))
+
+    docs = _map_files(_diff_file, paths, jobs, kwargs, stats=stats)
+    for path, (diff, error) in docs:
+        yield path, diff, error
+
+
+def write_wrapped_files(paths, widths, template, jobs=1, stats=None,
+                        **kwargs):
+    """Wrap Markdown files at each of widths and write them out.
+
+    Like wrap_files, but each file is lexed once and wrapped at all
+    widths, see TWMarkdown.parse_widths.  The file wrapped at a width
+    is written to template formatted with the {dir}, {stem} and {ext}
+    of the file's path and the {width}.  Yields (path, paths written,
+    error).
+    """
+    paths = list(_iter_md_files(paths))
+
+    func = functools.partial(_write_wrapped_file, widths=widths,
+                             template=template)
+    docs = _map_files(func, paths, jobs, kwargs, stats=stats)
+    for path, (out_paths, error) in docs:
+        yield path, out_paths, error
+
+
+# Modes of md-tw picked by its first argument, which parse_args in
+# main does not see.
+_main_epilog = """\
+other modes:
+  md-tw bench ...     time md-tw on a corpus of documents; see
+                      md-tw bench --help
+  md-tw --daemon ...  keep md-tw running to wrap documents sent by
+                      md-tw-client; see md-tw --daemon --help
+  md-tw --client ...  same as md-tw-client, which wraps documents with
+                      the daemon and starts faster
+
+To wrap a file named bench, give its path as ./bench or after --.
+"""
 
 
 def main():
+    if sys.argv[1:2] == ['bench']:
+        from markdown_textwrap import bench
+
+        return bench.main(sys.argv[2:])
+    if sys.argv[1:2] == ['--daemon']:
+        from markdown_textwrap import daemon
+
+        return daemon.daemon_main(sys.argv[2:])
+    if sys.argv[1:2] == ['--client']:
+        from markdown_textwrap import daemon
+
+        return daemon.client_main(sys.argv[2:])
+
     def parse_args():
-        parser = argparse.ArgumentParser()
+        import argparse
+
+        parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            epilog=_main_epilog
+        )
+
+        def widths(value):
+            return [int(w) for w in value.split(',')]
 
         # Options for args.
         w_opts = {
-            'type': int,
+            'type': widths,
             'dest':'width',
-            'default':72,
-            'help': 'Max. line width.  Default is 72.'
+            'default':[72],
+            'help': 'Max. line width, or comma separated widths to wrap '
+                    'documents at with --out-template.  Default is 72.'
+            }
+        j_opts = {
+            'type': int,
+            'dest': 'jobs',
+            'default': 1,
+            'help': 'Number of files, or parts of a single file, to wrap '
+                    'in parallel.  Default is 1.'
+            }
+        i_opts = {
+            'action': 'store_true',
+            'dest': 'in_place',
+            'help': 'Write wrapped documents back to their files.'
+            }
+        ch_opts = {
+            'action': 'store_true',
+            'dest': 'check',
+            'help': 'Only tell which documents are not wrapped; exit with '
+                    'status 1 if any are not.'
+            }
+        d_opts = {
+            'action': 'store_true',
+            'dest': 'diff',
+            'help': 'Print a unified diff of what wrapping would change '
+                    'instead of the wrapped documents; with --check, '
+                    'exit with status 1 if anything would change.'
+            }
+        c_opts = {
+            'dest': 'cache',
+            'default': _cache_path(),
+            'help': 'File that keeps track of wrapped documents for '
+                    '--in-place and --check.  Default is '
+                    '{}.'.format(_cache_path())
+            }
+        m_opts = {
+            'dest': 'mode',
+            'default': 'greedy',
+            'choices': ['greedy', 'optimal'],
+            'help': 'Fill lines greedily, or so as to minimize raggedness. '
+                    ' Default is greedy.'
+            }
+        e_opts = {
+            'dest': 'engine',
+            'default': 'fast',
+            'choices': ['fast', 'batch'],
+            'help': 'Fill paragraphs one at a time, or many at once with '
+                    'NumPy, which is faster for documents made mostly of '
+                    'paragraphs; without NumPy, batch is the same as '
+                    'fast.  Default is fast.'
+            }
+        me_opts = {
+            'dest': 'measure',
+            'default': 'chars',
+            'choices': ['chars', 'display'],
+            'help': 'Measure lines in characters, or in the columns a '
+                    'terminal shows them in: East Asian wide characters '
+                    'take two, combining marks none.  Default is chars.'
+            }
+        nc_opts = {
+            'action': 'store_const',
+            'const': None,
+            'dest': 'cache',
+            'help': 'Do not use a cache for --in-place and --check.'
+            }
+        o_opts = {
+            'metavar': 'TEMPLATE',
+            'dest': 'out_template',
+            'help': 'Write each document wrapped at each width to a file '
+                    'named after TEMPLATE, e.g. {dir}/{stem}-{width}{ext}; '
+                    'documents are lexed once for all widths.'
+            }
+        tc_opts = {
+            'metavar': 'DIR',
+            'dest': 'token_cache',
+            'help': 'Keep the lexed tokens of documents in DIR, and load '
+                    'them instead of lexing documents lexed before, at '
+                    'any width or mode; e.g. ~/.cache/md-tw/tokens.'
+            }
+        mm_opts = {
+            'action': 'store_true',
+            'dest': 'use_mmap',
+            'help': 'Read files through a memory map, a window at a '
+                    'time; for very large files.  Not used with '
+                    '--in-place, --check, --diff and --out-template.'
+            }
+        s_opts = {
+            'action': 'store_true',
+            'dest': 'stats',
+            'help': 'Write the time spent in and calls of each handler, '
+                    'lexer rule and tw_fill as JSON to stderr.'
+            }
+        cs_opts = {
+            'metavar': 'REF',
+            'dest': 'changed_since',
+            'help': 'Only Markdown documents changed since the git commit '
+                    'REF, in the given paths if any.'
+            }
+        st_opts = {
+            'action': 'store_true',
+            'dest': 'staged',
+            'help': 'Only Markdown documents with changes staged in git, '
+                    'in the given paths if any.'
             }
         f_opts = {
-            'type': argparse.FileType('r'),
-            'help': 'File path of Markdown document.'
+            'nargs': '*',
+            'help': 'File path of Markdown document or directory of '
+                    'Markdown documents; - reads from stdin.'
             }
 
         # Define expected args.
         parser.add_argument('-w', '--width', **w_opts)
+        parser.add_argument('-m', '--mode', **m_opts)
+        parser.add_argument('--measure', **me_opts)
+        parser.add_argument('--engine', **e_opts)
+        parser.add_argument('-j', '--jobs', **j_opts)
+        parser.add_argument('-i', '--in-place', **i_opts)
+        parser.add_argument('--check', **ch_opts)
+        parser.add_argument('--diff', **d_opts)
+        parser.add_argument('--out-template', **o_opts)
+        parser.add_argument('--cache', **c_opts)
+        parser.add_argument('--no-cache', **nc_opts)
+        parser.add_argument('--token-cache', **tc_opts)
+        parser.add_argument('--mmap', **mm_opts)
+        parser.add_argument('--stats', **s_opts)
+        parser.add_argument('--changed-since', **cs_opts)
+        parser.add_argument('--staged', **st_opts)
         parser.add_argument('md_file', **f_opts)
 
         # Parse 'em.
         a = parser.parse_args()
+        if not (a.md_file or a.changed_since or a.staged):
+            parser.error('the following arguments are required: md_file')
+        if a.in_place and (a.check or a.diff):
+            parser.error('--in-place does not go with --check or --diff')
+        if a.engine == 'batch' and a.mode == 'optimal':
+            parser.error('--engine batch does not go with --mode optimal')
+        if a.out_template:
+            if a.in_place or a.check or a.diff:
+                parser.error('--out-template does not go with --in-place, '
+                             '--check or --diff')
+            try:
+                out_path = _out_path(a.out_template, 'doc.md', 0)
+            except (IndexError, KeyError, ValueError):
+                parser.error('bad --out-template: {}'.format(a.out_template))
+            if len(a.width) > 1 and out_path == _out_path(a.out_template,
+                                                          'doc.md', 1):
+                parser.error('--out-template needs {width} for several '
+                             'widths')
+        elif len(a.width) > 1:
+            parser.error('several widths need --out-template')
+
+        return {
+            'width': a.width,
+            'mode': a.mode,
+            'measure': a.measure,
+            'engine': a.engine,
+            'jobs': a.jobs,
+            'in_place': a.in_place,
+            'check': a.check,
+            'diff': a.diff,
+            'out_template': a.out_template,
+            'cache': a.cache,
+            'token_cache': a.token_cache,
+            'stats': TWStats() if a.stats else None,
+            'use_mmap': a.use_mmap,
+            'changed_since': a.changed_since,
+            'staged': a.staged,
+            'md_files': a.md_file
+        }
 
-        return {'width': a.width, 'text': a.md_file.read()}
-
-    def wrap(text, width):
-        return TWMarkdown(tw_width=width)(text)
-
-    def out(text):
-        print('{}'.format(text))
-
-    return out(wrap(**parse_args()))
+    def wrap(md_files, width, mode, measure, engine, jobs, in_place, check,
+             diff, out_template, cache, token_cache, stats, use_mmap):
+        options = {'tw_width': width[0], 'tw_mode': mode}
+        if engine != 'fast':
+            options['tw_engine'] = engine
+        if measure != 'chars':
+            options['tw_measure'] = measure
+        if token_cache:
+            options['tw_token_cache'] = TWTokenCache(token_cache)
+
+        if out_template:
+            docs = write_wrapped_files(md_files, width, out_template, jobs,
+                                       stats, **options)
+            return ((md_file, [], error) for md_file, _, error in docs)
+
+        if diff:
+            docs = diff_files(md_files, jobs, stats, **options)
+            return ((md_file, [d] if d else [],
+                     'not wrapped' if check and d else error)
+                    for md_file, d, error in docs)
+
+        if check:
+            cache = TWCache(cache) if cache else None
+            docs = check_files(md_files, jobs, cache, stats, **options)
+            return ((md_file, [],
+                     'not wrapped' if wrapped is False else error)
+                    for md_file, wrapped, error in docs)
+
+        if in_place:
+            cache = TWCache(cache) if cache else None
+            docs = rewrite_files(md_files, jobs, cache, stats, **options)
+            return ((md_file, [], error) for md_file, _, error in docs)
+
+        if len(md_files) == 1 and not os.path.isdir(md_files[0]):
+            if jobs > 1 and md_files[0] != '-' and not use_mmap:
+                # Wrap parts of a single document in parallel.
+                return wrap_parallel(md_files[0], jobs, options, stats)
+
+            # Write out a single document as it gets wrapped.
+            return wrap_stream(md_files[0], options, stats, use_mmap)
+
+        docs = wrap_files(md_files, jobs, stats, use_mmap, **options)
+        return ((md_file, [] if text is None else [text, '\n'], error)
+                for md_file, text, error in docs)
+
+    def wrap_stream(md_file, options, stats, use_mmap):
+        md = TWMarkdown(tw_stats=stats, **options)
+        try:
+            if md_file == '-':
+                yield md_file, chain(md.parse_stream(sys.stdin)), None
+            elif use_mmap:
+                lines = mmap_lines(md_file)
+                yield md_file, chain(md.parse_stream(lines)), None
+            else:
+                with open(md_file) as f:
+                    yield md_file, chain(md.parse_stream(f)), None
+        except OSError as e:
+            yield md_file, None, e.strerror
+
+    def wrap_parallel(md_file, jobs, options, stats):
+        md = TWMarkdown(tw_stats=stats, **options)
+        try:
+            with open(md_file) as f:
+                text = f.read()
+        except OSError as e:
+            return [(md_file, None, e.strerror)]
+
+        return [(md_file, [md.parse_parallel(text, jobs), '\n'], None)]
+
+    def chain(blocks):
+        yield from blocks
+        yield '\n'
+
+    def out(docs):
+        status = 0
+        for md_file, blocks, error in docs:
+            for block in blocks or []:
+                sys.stdout.write(block)
+
+            if error:
+                print('md-tw: {}: {}'.format(md_file, error), file=sys.stderr)
+                status = 1
+
+        return status
+
+    def report(stats):
+        import json
+
+        json.dump(stats.as_dict(), sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write('\n')
+
+    args = parse_args()
+    changed_since = args.pop('changed_since')
+    staged = args.pop('staged')
+    if changed_since or staged:
+        # Wrap the documents changed in git.
+        from markdown_textwrap import git
+
+        try:
+            args['md_files'] = git.changed_files(changed_since, staged,
+                                                 args['md_files'])
+        except (OSError, git.GitError) as e:
+            print('md-tw: git: {}'.format(e), file=sys.stderr)
+            return 1
+
+    status = out(wrap(**args))
+    if args['stats']:
+        report(args['stats'])
+
+    return status
@@ -62,8 +62,14 @@ config = {
     'py_modules': ['md_tw'],
     'packages': ['markdown_textwrap'],
     'install_requires': ['mistune==0.8.3'],
+    'extras_require': {
+        'batch': ['numpy']
+    },
     'entry_points': {
-        'console_scripts': ['md-tw = md_tw:main']
+        'console_scripts': [
+            'md-tw = md_tw:main',
+            'md-tw-client = markdown_textwrap.daemon:client_main',
+        ]
     }
 }
 setup(**config)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+
+from nose import tools as nose_tools
+
+from markdown_textwrap import bench
+from md_tw import TWMarkdown
+
+
+class TestBench(object):
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='md-tw-tests-')
+
+    def test_gen_corpus(self):
+        docs = bench.gen_corpus(3, blocks=20)
+
+        nose_tools.assert_equal(docs, bench.gen_corpus(3, blocks=20))
+        nose_tools.assert_equal(len(docs), 3)
+
+        tokens = TWMarkdown().block(docs[0])
+        types = set(t['type'] for t in tokens)
+        for type_ in ['paragraph', 'list_start', 'block_quote_start',
+                      'footnote_start']:
+            assert type_ in types
+
+    def test_bench(self):
+        results = bench.bench(bench.gen_corpus(2, blocks=5), repeat=1)
+
+        nose_tools.assert_equal(sorted(results), sorted(bench.phases))
+        for phase in bench.phases:
+            assert results[phase]['docs_per_s'] > 0
+            assert results[phase]['mb_per_s'] > 0
+
+    def test_compare(self):
+        baseline = dict((p, {'docs_per_s': 100.0}) for p in bench.phases)
+        results = {'lex': {'docs_per_s': 95.0},
+                   'render': {'docs_per_s': 80.0},
+                   'total': {'docs_per_s': 120.0}}
+
+        changes = list(bench.compare(results, baseline, tolerance=0.1))
+        nose_tools.assert_equal([(p, round(c, 2), r) for p, c, r in changes],
+                                [('lex', -0.05, False),
+                                 ('render', -0.2, True),
+                                 ('total', 0.2, False)])
+
+    def test_main_baseline(self):
+        path = os.path.join(self.tmp_dir, 'baseline.json')
+        args = ['--docs', '2', '-n', '1']
+
+        nose_tools.assert_equal(bench.main(args + ['--save', path]), 0)
+        with open(path) as f:
+            saved = json.load(f)
+        nose_tools.assert_equal(saved['docs'], 2)
+
+        # Make the baseline much faster than anything can be.
+        for phase in bench.phases:
+            saved['results'][phase]['docs_per_s'] *= 1e6
+        with open(path, 'w') as f:
+            json.dump(saved, f)
+
+        nose_tools.assert_equal(bench.main(args + ['--baseline', path]), 1)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
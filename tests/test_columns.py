@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+
+from nose import tools as nose_tools
+
+from markdown_textwrap import columns
+
+
+class TestColumns(object):
+
+    def test_char_width(self):
+        for c, width in [('a', 1), ('é', 1), ('\u0301', 0), ('\u200b', 0),
+                         ('\u1161', 0), ('日', 2), ('한', 2), ('\uff21', 2),
+                         ('\U0001f44d', 2), ('\U00020000', 2),
+                         ('\U0001d11e', 1)]:
+            nose_tools.assert_equal(columns.char_width(c), width)
+
+    def test_width(self):
+        nose_tools.assert_equal(columns.width(''), 0)
+        nose_tools.assert_equal(columns.width('lorem ipsum'), 11)
+        nose_tools.assert_equal(columns.width('café'), 4)
+        nose_tools.assert_equal(columns.width('cafe\u0301'), 4)
+        nose_tools.assert_equal(columns.width('日本語 text'), 11)
+        nose_tools.assert_equal(columns.width('\U0001f44d\U00020000a'), 5)
+
+        txt = 'x\u0301日\U0001f44d\U0001d11e\u200bé\U00020000'
+        nose_tools.assert_equal(columns.width(txt),
+                                sum(columns.char_width(c) for c in txt))
+
+    def test_fit(self):
+        nose_tools.assert_equal(columns.fit('lorem', 3), 3)
+        nose_tools.assert_equal(columns.fit('lorem', 10), 5)
+        nose_tools.assert_equal(columns.fit('日本語', 3), 1)
+        nose_tools.assert_equal(columns.fit('日本語', 1), 0)
+        # Combining marks go with the character before them.
+        nose_tools.assert_equal(columns.fit('e\u0301\u0301e', 1), 3)
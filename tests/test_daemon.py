@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from nose import tools as nose_tools
+
+from markdown_textwrap import daemon
+from md_tw import TWMarkdown
+
+
+class TestDaemon(object):
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='md-tw-tests-')
+        self.path = os.path.join(self.tmp_dir, 'md-tw.sock')
+
+    def _start(self, **kwargs):
+        server = daemon.TWDaemon(self.path, **kwargs)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+
+        return server, thread
+
+    def test_request(self):
+        server, thread = self._start(idle_timeout=0.5)
+
+        text = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, '
+                'sed do eiusmod tempor incididunt ut labore et dolore.\n\n'
+                '> Ut enim ad minim veniam, quis nostrud exercitation '
+                'ullamco laboris nisi ut aliquip ex ea commodo.\n')
+        for width in [30, 30, 50]:
+            options = {'tw_width': width}
+            nose_tools.assert_equal(daemon.request(text, options, self.path),
+                                    TWMarkdown(**options)(text))
+
+        # One instance is kept for each set of options, for the most
+        # recently used options.
+        nose_tools.assert_equal(len(server._instances), 2)
+        for width in range(10, 10 + 2 * daemon._max_instances):
+            daemon.request(text, {'tw_width': width}, self.path)
+        nose_tools.assert_equal(len(server._instances),
+                                daemon._max_instances)
+        assert (('tw_width', width),) in server._instances
+
+        thread.join(5)
+        assert not thread.is_alive()
+        assert not os.path.exists(self.path)
+
+    def test_request_errors(self):
+        server, thread = self._start(max_size=10, idle_timeout=0.5)
+
+        with nose_tools.assert_raises(daemon.DaemonError):
+            daemon.request('Lorem ipsum dolor sit amet.', {}, self.path)
+        # Documents too large for the socket's buffers too.
+        with nose_tools.assert_raises(daemon.DaemonError):
+            daemon.request('Lorem ipsum.\n' * (1 << 20), {}, self.path)
+        with nose_tools.assert_raises(daemon.DaemonError):
+            daemon.request('Lorem.', {'tw_mode': 'fast'}, self.path)
+        nose_tools.assert_equal(
+            daemon.request('Lorem.', {'tw_width': 20}, self.path),
+            'Lorem.\n')
+
+        thread.join(5)
+        assert not thread.is_alive()
+
+        with nose_tools.assert_raises(OSError):
+            daemon.request('Lorem.', {}, self.path)
+
+    def test_socket_path_taken(self):
+        # Files that are not sockets are left alone.
+        with open(self.path, 'w') as f:
+            f.write('Notes.\n')
+        with nose_tools.assert_raises(daemon.DaemonError):
+            daemon.TWDaemon(self.path)
+        nose_tools.assert_equal(daemon.daemon_main(['--socket', self.path]),
+                                1)
+        with open(self.path) as f:
+            nose_tools.assert_equal(f.read(), 'Notes.\n')
+        os.unlink(self.path)
+
+        # So is the socket of a daemon that is running.
+        server, thread = self._start(idle_timeout=0.5)
+        with nose_tools.assert_raises(daemon.DaemonError):
+            daemon.TWDaemon(self.path)
+        nose_tools.assert_equal(
+            daemon.request('Lorem.', {}, self.path), 'Lorem.\n')
+
+        thread.join(5)
+        assert not thread.is_alive()
+
+        # A socket left by a daemon that is gone is replaced.
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        server, thread = self._start(idle_timeout=0.5)
+        nose_tools.assert_equal(
+            daemon.request('Lorem.', {}, self.path), 'Lorem.\n')
+
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from nose import tools as nose_tools
+
+from markdown_textwrap import git
+
+
+class TestGit(object):
+
+    def setup(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp(prefix='md-tw-tests-')
+        os.chdir(self.tmp_dir)
+
+        self._git('init', '-q')
+        os.mkdir('docs')
+        for f in ['a.md', 'docs/b.md', 'docs/c.markdown', 'd.txt']:
+            self._write(f, 'Lorem ipsum.\n')
+        self._git('add', '.')
+        self._git('commit', '-q', '-m', 'Add documents.')
+
+    def _git(self, *args):
+        subprocess.run(('git', '-c', 'user.name=md-tw',
+                        '-c', 'user.email=md-tw@example.com') + args,
+                       check=True)
+
+    def _write(self, f, text):
+        with open(f, 'a') as f_:
+            f_.write(text)
+
+    def test_changed_files(self):
+        for f in ['a.md', 'docs/b.md', 'docs/c.markdown', 'd.txt']:
+            self._write(f, 'Dolor sit amet.\n')
+        self._git('add', 'docs/b.md', 'd.txt')
+        # Deleted files are left out.
+        self._git('rm', '-q', '--cached', 'docs/c.markdown')
+
+        nose_tools.assert_equal(git.changed_files(staged=True),
+                                ['docs/b.md'])
+        nose_tools.assert_equal(git.changed_files('HEAD'),
+                                ['a.md', 'docs/b.md'])
+        nose_tools.assert_equal(git.changed_files('HEAD', paths=['docs']),
+                                ['docs/b.md'])
+
+        # Paths are relative to the current directory.
+        os.chdir('docs')
+        nose_tools.assert_equal(git.changed_files(staged=True), ['b.md'])
+
+    def test_changed_files_errors(self):
+        nose_tools.assert_raises(git.GitError, git.changed_files, 'nope')
+        nose_tools.assert_raises(git.GitError, git.changed_files,
+                                 '--output=x')
+        assert not os.path.exists('x')
+
+    def teardown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
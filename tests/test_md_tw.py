@@ -20,14 +20,22 @@
 
 import os
 import shutil
+import subprocess
+import sys
 import tempfile
 import textwrap
 
+from concurrent.futures import ThreadPoolExecutor
+
 from mistune import Renderer
-from nose import tools as nose_tools
+from nose import SkipTest, tools as nose_tools
 from pkg_resources import resource_string, resource_filename
 
-from md_tw import TWBlockLexer, TWInlineLexer, TWRenderer, TWMarkdown
+from md_tw import (TWToken, TWBlockLexer, TWInlineLexer, TWContext,
+                   TWRenderer, TWTextWrapper, TWOptimalWrapper,
+                   TWBatchWrapper, TWMarkdown,
+                   TWStats, TWCache, TWTokenCache, check_files, diff_files, mmap_lines,
+                   rewrite_files, wrap_files, write_wrapped_files)
 
 def _get_data(f):
     rs = resource_string(__name__, '/'.join(['data', f]))
@@ -677,6 +685,30 @@ class TestTWBlockLexer(object):
 
         self._validate(tokens, 'paragraph', expected_ps)
 
+    def test_tokens(self):
+        tokens = self._parse('blexer-lists.md')
+
+        for token in tokens:
+            assert isinstance(token, TWToken)
+            assert not hasattr(token, '__dict__')
+
+        # Tokens read like mistune's token dicts.
+        token = tokens[1]
+        nose_tools.assert_equal(token.as_dict(),
+                                {'type': 'list_item_start', 'text': '+   ',
+                                 'spaces': 4})
+        nose_tools.assert_equal(token['text'], token.text)
+        nose_tools.assert_equal(token.get('key'), None)
+        assert 'spaces' in token and 'key' not in token
+        nose_tools.assert_raises(KeyError, lambda: token['key'])
+
+        # Tables are tokens too.
+        tokens = self.bl.parse('a | b\n--|--\n1 | 2\n')
+        nose_tools.assert_equal(tokens[-1].as_dict(),
+                                {'type': 'table', 'header': ['a', 'b'],
+                                 'align': [None, None],
+                                 'cells': [['1', '2']]})
+
     def teardown(self):
         pass
 
@@ -743,6 +775,179 @@ class TestTWRenderer(object):
         nose_tools.assert_equal(renderer.tw.width, 80)
 
 
+    def test_tw_engine(self):
+        nose_tools.assert_equal(type(TWRenderer().tw), TWTextWrapper)
+        nose_tools.assert_equal(type(TWRenderer(tw_engine='textwrap').tw),
+                                textwrap.TextWrapper)
+        nose_tools.assert_raises(ValueError, TWRenderer, tw_engine='par')
+
+        for f in ['renderer-paragraphs.md', 'renderer-block-quote.md',
+                  'renderer-lists.md', 'renderer-footnotes.md']:
+            txt = self._get(f)
+            for width in [20, 72]:
+                nose_tools.assert_equal(
+                    TWMarkdown(tw_width=width)(txt),
+                    TWMarkdown(tw_width=width, tw_engine='textwrap')(txt))
+
+
+    def test_tw_text_wrapper(self):
+        txt = ('A well-known  fact:\tthe quick brown fox--a lazy '
+               'dog--jumped over a-very-long-hyphenated-word and '
+               'supercalifragilisticexpialidocious.')
+
+        for width in [1, 5, 12, 30]:
+            for indents in [('', ''), ('> ', '  '), ('> > ', '> > ')]:
+                kwargs = dict(width=width, initial_indent=indents[0],
+                              subsequent_indent=indents[1])
+                nose_tools.assert_equal(
+                    TWTextWrapper(**kwargs).fill(txt),
+                    textwrap.TextWrapper(**kwargs).fill(txt))
+
+
+    def test_tw_fill_cache(self):
+        renderer = TWRenderer(tw_width=10, tw_cache_size=2)
+
+        wrapped = renderer.tw_fill('one two three four')
+        nose_tools.assert_equal(renderer.tw_fill('one two three four'),
+                                wrapped)
+        info = renderer.tw_cache_info()
+        nose_tools.assert_equal((info.hits, info.misses, info.maxsize),
+                                (1, 1, 2))
+
+        # Options are part of the key.
+        nose_tools.assert_equal(
+            renderer.tw_fill('one two three four', initial_indent='> ',
+                             subsequent_indent='> '),
+            '> one two\n> three\n> four')
+        nose_tools.assert_equal(renderer.tw_cache_info().misses, 2)
+
+        # The least recently used fill is dropped.
+        renderer.tw_fill('five six')
+        renderer.tw_set(initial_indent='', subsequent_indent='')
+        renderer.tw_fill('one two three four')
+        info = renderer.tw_cache_info()
+        nose_tools.assert_equal((info.misses, info.currsize), (4, 2))
+
+        # The cache is shared across documents.
+        md = TWMarkdown()
+        txt = self._get('renderer-paragraphs.md')
+        md(txt)
+        hits = md.renderer.tw_cache_info().hits
+        nose_tools.assert_equal(md(txt), self.md_wrap(txt))
+        assert md.renderer.tw_cache_info().hits > hits
+
+
+    def test_tw_mode_optimal(self):
+        nose_tools.assert_equal(type(TWRenderer(tw_mode='optimal').tw),
+                                TWOptimalWrapper)
+        nose_tools.assert_raises(ValueError, TWRenderer, tw_mode='optimal',
+                                 tw_engine='textwrap')
+        nose_tools.assert_raises(ValueError, TWRenderer, tw_mode='best')
+
+        renderer = TWRenderer(tw_width=6, tw_mode='optimal')
+        nose_tools.assert_equal(renderer.tw_fill('aaa bb cc ddddd'),
+                                'aaa\nbb cc\nddddd')
+        nose_tools.assert_equal(renderer.tw_fill('  '), '')
+
+        # Long words are broken.
+        nose_tools.assert_equal(renderer.tw_fill('aaa bb cc ddddd',
+                                                 initial_indent='> ',
+                                                 subsequent_indent='> '),
+                                '> aaa\n> bb\n> cc\n> dddd\n> d')
+
+        txt = self._get('renderer-paragraphs.md')
+        wrapped = TWMarkdown(tw_width=40, tw_mode='optimal')(txt)
+        nose_tools.assert_equal(wrapped.split(), txt.split())
+        for line in wrapped.splitlines():
+            assert len(line) <= 40
+
+
+    def test_tw_engine_batch(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest('NumPy is not installed')
+
+        renderer = TWRenderer(tw_engine='batch')
+        nose_tools.assert_equal(type(renderer.tw), TWBatchWrapper)
+        assert renderer.tw_batches()
+
+        files = ['renderer-paragraphs.md', 'renderer-block-quote.md',
+                 'renderer-lists.md', 'renderer-footnotes.md',
+                 'renderer-block-code.md', 'renderer-heading.md']
+        for f in files:
+            txt = self._get(f)
+            for width in [20, 40, 72]:
+                nose_tools.assert_equal(
+                    TWMarkdown(tw_width=width, tw_engine='batch')(txt),
+                    TWMarkdown(tw_width=width)(txt))
+            nose_tools.assert_equal(
+                TWMarkdown(tw_engine='batch').parse_widths(txt, [30, 60]),
+                TWMarkdown().parse_widths(txt, [30, 60]))
+
+        ctx = TWContext(12, '> ', '  ', True)
+        items = [('a bb  ccc dddd eeeee ffffff g', ctx), ('', ctx),
+                 ('a well-known fact', ctx), ('supercalifragilistic', ctx)]
+        nose_tools.assert_equal(TWBatchWrapper().fill_many(items), [
+            '> a bb  ccc\n  dddd eeeee\n  ffffff g', '',
+            # Words with hyphens and words longer than a line are left
+            # to TWTextWrapper.
+            None, None,
+        ])
+
+    def test_tw_engine_batch_without_numpy(self):
+        numpy = sys.modules.get('numpy')
+        sys.modules['numpy'] = None
+        try:
+            assert not TWRenderer(tw_engine='batch').tw_batches()
+            items = [('a bb ccc', TWContext(12, '', '', True))]
+            nose_tools.assert_equal(TWBatchWrapper().fill_many(items),
+                                    [None])
+
+            # Blocks are rendered once, as with the fast engine.
+            md = TWMarkdown(tw_engine='batch')
+            def _render_batches(*args):
+                raise AssertionError('blocks rendered in batches')
+            md._render_batches = _render_batches
+
+            txt = self._get('renderer-paragraphs.md')
+            nose_tools.assert_equal(md(txt), TWMarkdown()(txt))
+            nose_tools.assert_equal(md.parse_widths(txt, [30, 60]),
+                                    TWMarkdown().parse_widths(txt, [30, 60]))
+        finally:
+            if numpy is None:
+                del sys.modules['numpy']
+            else:
+                sys.modules['numpy'] = numpy
+
+    def test_tw_measure_display(self):
+        nose_tools.assert_raises(ValueError, TWRenderer, tw_measure='cells')
+        nose_tools.assert_raises(ValueError, TWRenderer, tw_measure='display',
+                                 tw_engine='textwrap')
+
+        txt = '日本語の文章 を折り返す 漢字 かな カナ'
+        for mode in ['greedy', 'optimal']:
+            renderer = TWRenderer(tw_width=12, tw_mode=mode,
+                                  tw_measure='display')
+            nose_tools.assert_equal(renderer.tw_fill(txt),
+                                    '日本語の文章\nを折り返す\n漢字 かな\nカナ')
+
+            # Long words are broken at characters that fit.
+            nose_tools.assert_equal(
+                renderer.tw_fill('日本語の文章を折り返す', initial_indent='> ',
+                                 subsequent_indent='> '),
+                '> 日本語の文\n> 章を折り返\n> す')
+
+            # Text with no wide or zero width characters is wrapped as
+            # it is without tw_measure.
+            for f in ['renderer-paragraphs.md', 'renderer-lists.md']:
+                txt_ = self._get(f)
+                nose_tools.assert_equal(
+                    TWMarkdown(tw_width=40, tw_mode=mode,
+                               tw_measure='display')(txt_),
+                    TWMarkdown(tw_width=40, tw_mode=mode)(txt_))
+
+
     def test_tw_set_with_valid_opts(self):
         renderer  = TWRenderer()
 
@@ -778,6 +983,21 @@ class TestTWRenderer(object):
         nose_tools.assert_equal(getattr(renderer.tw, 'insert_between_paragraphs',
                                  None), None)
 
+    def test_tw_fill_context(self):
+        renderer = TWRenderer(tw_width=10)
+        ctx = renderer.context()
+        nose_tools.assert_equal(ctx, TWContext(10, '', '', True))
+
+        item_ctx = ctx.indent('> ').indent('  ', width=12)
+        nose_tools.assert_equal(item_ctx, TWContext(12, '>   ', '>   ', True))
+
+        # The renderer's own options are left alone.
+        nose_tools.assert_equal(renderer.tw_fill('one two three', item_ctx),
+                                '>   one two\n>   three')
+        nose_tools.assert_equal(renderer.context(), ctx)
+        nose_tools.assert_equal(renderer.tw_fill('one two three'),
+                                'one two\nthree')
+
     def test_render_paragraph(self):
         txt = self._md('renderer-paragraphs.md')
         expected_txt = self._get('renderer-paragraphs-w.md')
@@ -866,5 +1086,559 @@ class TestTWMarkdown(object):
         assert isinstance(self.md.block, TWBlockLexer)
 
 
+    def test_parse_stream(self):
+        for f in ['renderer-paragraphs.md', 'renderer-block-quote.md',
+                  'renderer-lists.md', 'renderer-footnotes.md',
+                  'renderer-fences.md', 'renderer-block-html.md']:
+            txt = _get_data(f)
+            blocks = list(self.md.parse_stream(txt.splitlines(True)))
+
+            assert len(blocks) > 1
+            nose_tools.assert_equal(''.join(blocks), self.md(txt))
+
+
+    def test_output(self):
+        # mistune's Markdown.output renders the tokens of the whole
+        # text with the renderer's context.
+        md = TWMarkdown(tw_width=30)
+        for f in ['renderer-paragraphs.md', 'renderer-lists.md',
+                  'renderer-lheading.md']:
+            txt = _get_data(f)
+            nose_tools.assert_equal(md.output(txt).rstrip(),
+                                    md(txt).rstrip())
+
+
+    def test_parse_lazy(self):
+        txt = 'A paragraph.\n\n' * 50 + '- An item.\n- Another.\n'
+
+        # Top-level blocks are rendered one at a time.
+        sizes = []
+        render = self.md._render
+        def _render(tokens):
+            sizes.append(len(tokens))
+            return render(tokens)
+        self.md._render = _render
+
+        nose_tools.assert_equal(self.md(txt),
+                                ''.join(TWMarkdown().parse_stream([txt])))
+        nose_tools.assert_equal(len(sizes), 51)
+        nose_tools.assert_equal(sum(sizes), len(TWBlockLexer().parse(txt)))
+        assert max(sizes) < 10
+
+    def test_check(self):
+        txt = _get_data('renderer-lists.md')
+        wrapped = self.md(txt)
+
+        assert self.md.check(wrapped)
+        assert not self.md.check(txt)
+        assert not self.md.check(wrapped + 'More.\n')
+
+        # Blocks after the first one that differs are not rendered.
+        calls = []
+        render = self.md._render
+        def _render(tokens):
+            calls.append(tokens)
+            return render(tokens)
+        self.md._render = _render
+
+        txt = 'A long paragraph. ' * 10 + '\n\n' + 'Another.\n\n' * 50
+        assert not self.md.check(txt)
+        assert len(calls) < 5
+
+    def test_diff(self):
+        md = TWMarkdown(tw_width=20)
+        txt = ('A short one.\n\nA paragraph that is too long for one '
+               'line.\n\nAnother short one.')
+
+        # Changes closer than twice the context make one hunk.
+        nose_tools.assert_equal(list(md.diff(txt, 'doc.md')), [
+            '--- doc.md\n',
+            '+++ doc.md\n',
+            '@@ -1,5 +1,7 @@\n',
+            ' A short one.\n',
+            ' \n',
+            '-A paragraph that is too long for one line.\n',
+            '+A paragraph that is\n',
+            '+too long for one\n',
+            '+line.\n',
+            ' \n',
+            '-Another short one.\n',
+            '\\ No newline at end of file\n',
+            '+Another short one.\n',
+        ])
+
+        # Context is taken from the blocks around a change.
+        txt = 'One.\n\nTwo.\n\n\nThree.\n\nFour.\n'
+        nose_tools.assert_equal(list(md.diff(txt, 'doc.md', 1)), [
+            '--- doc.md\n',
+            '+++ doc.md\n',
+            '@@ -4,3 +4,2 @@\n',
+            ' \n',
+            '-\n',
+            ' Three.\n',
+        ])
+
+        for f in ['renderer-lists.md', 'renderer-footnotes.md']:
+            nose_tools.assert_equal(list(self.md.diff(self.md(_get_data(f)))),
+                                    [])
+
+    def test_diff_patch(self):
+        if not (shutil.which('patch') and shutil.which('git')):
+            raise SkipTest('patch or git is not installed')
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for f in ['renderer-paragraphs.md', 'renderer-lists.md',
+                      'renderer-block-quote.md', 'renderer-footnotes.md']:
+                txt = _get_data(f).replace('\n\n', '\n\n\n')
+                for width, cmd in [(20, ['patch', '-s', '-p0']),
+                                   (72, ['patch', '-s', '-p0']),
+                                   (20, ['git', 'apply', '-p0'])]:
+                    md = TWMarkdown(tw_width=width)
+                    path = os.path.join(tmp_dir, 'doc.md')
+                    with open(path, 'w') as f_:
+                        f_.write(txt)
+
+                    # The diff applies and gives the output.
+                    diff = ''.join(md.diff(txt, 'doc.md'))
+                    subprocess.run(cmd, input=diff, cwd=tmp_dir, check=True,
+                                   universal_newlines=True)
+                    with open(path) as f_:
+                        nose_tools.assert_equal(f_.read(), md(txt))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_parse_parallel(self):
+        for f in ['renderer-lists.md', 'renderer-footnotes.md',
+                  'renderer-fences.md', 'renderer-block-html.md']:
+            txt = _get_data(f)
+            for part_size in [1, 200]:
+                nose_tools.assert_equal(
+                    self.md.parse_parallel(txt, 2, part_size), self.md(txt)
+                )
+
+        # Footnotes defined again in a later part are dropped; a fence
+        # opened in one part is closed in another.
+        txt = ('Para[^1].\n\n[^1]: One.\n\n> [^1]: Two.\n\n'
+               '[^1]: Three.\n\n```\nnot\n\nwrapped\n```\n')
+        for jobs in [1, 2]:
+            nose_tools.assert_equal(self.md.parse_parallel(txt, jobs, 1),
+                                    self.md(txt))
+
+    def test_parse_stream_held_back_blocks(self):
+        txt = ('Para one.\n\n'
+               '```\nfenced\n\ncode\n```\n\n'
+               'Para two.\n```\n\nnot fenced\n')
+
+        nose_tools.assert_equal(
+            ''.join(self.md.parse_stream(txt.splitlines(True))),
+            self.md(txt))
+
+        txt = '[a\n\nb]: http://example.org/\n\nPara.\n'
+        nose_tools.assert_equal(
+            ''.join(self.md.parse_stream(txt.splitlines(True))),
+            self.md(txt))
+
+
+    def test_wrap_blocks(self):
+        txt = _get_data('renderer-lists.md')
+        blocks = self.md.wrap_blocks(txt)
+
+        nose_tools.assert_equal(self.md.join_blocks(blocks), self.md(txt))
+        nose_tools.assert_equal(blocks[0]['start'], 0)
+        nose_tools.assert_equal(blocks[-1]['end'], len(txt))
+        for b, next_b in zip(blocks, blocks[1:]):
+            nose_tools.assert_equal(b['end'], next_b['start'])
+            nose_tools.assert_equal(b['end_line'], next_b['start_line'])
+            nose_tools.assert_equal(next_b['start_line'],
+                                    txt.count('\n', 0, next_b['start']))
+        nose_tools.assert_equal(blocks[0]['start_line'], 0)
+        nose_tools.assert_equal(blocks[-1]['end_line'],
+                                len(txt.splitlines()))
+
+    def test_wrap_range(self):
+        txt = _get_data('renderer-paragraphs.md')
+        blocks = self.md.wrap_blocks(txt)
+        lines = txt.splitlines(True)
+
+        for line in range(len(lines)):
+            block = self.md.wrap_range(txt, line, line)
+            b = [b for b in blocks if b['end_line'] > line][0]
+            nose_tools.assert_equal(
+                (block['start'], block['end'], block['start_line'],
+                 block['end_line']),
+                (b['start'], b['end'], b['start_line'], b['end_line']))
+
+        # Wrap an edited paragraph of a wrapped document.
+        wrapped = self.md(txt).splitlines(True)
+        wrapped[2] = 'Edited   text ' * 10 + '\n'
+        edited = ''.join(wrapped)
+        block = self.md.wrap_range(edited, 2, 3)
+        wrapped[block['start_line']:block['end_line']] = [block['wrapped']]
+        nose_tools.assert_equal(''.join(wrapped), self.md(edited))
+
+        # The whole document.
+        block = self.md.wrap_range(txt, 0, len(lines))
+        nose_tools.assert_equal(block['wrapped'], self.md(txt))
+
+    def test_wrap_range_fence(self):
+        txt = ('Para one.\n\n```\nfenced\n\nnot a paragraph\n```\n\n'
+               'Para two.\n')
+        block = self.md.wrap_range(txt, 5, 6)
+        nose_tools.assert_equal((block['start_line'], block['end_line']),
+                                (2, 8))
+        nose_tools.assert_equal(block['wrapped'],
+                                '```\nfenced\n\nnot a paragraph\n```\n\n')
+
+
+    def test_rewrap(self):
+        txt = _get_data('renderer-paragraphs.md')
+        blocks = self.md.wrap_blocks(txt)
+        i = txt.index('Mere mobs')
+
+        edits = [
+            (i, i, 'Edited text. '),
+            (0, 0, 'New first paragraph.\n\n'),
+            (len(txt), len(txt), '\n```\nfenced\n'),
+            (txt.index('\n\n'), txt.index('\n\n') + 2, ' '),
+        ]
+        for start, end, replacement in edits:
+            new_txt, new_blocks = self.md.rewrap(txt, blocks, start, end,
+                                                 replacement)
+
+            nose_tools.assert_equal(new_txt,
+                                    txt[:start] + replacement + txt[end:])
+            nose_tools.assert_equal(self.md.join_blocks(new_blocks),
+                                    self.md(new_txt))
+
+        # Blocks after the edit are reused.
+        new_txt, new_blocks = self.md.rewrap(txt, blocks, i, i, 'x')
+        nose_tools.assert_equal(new_blocks[-1]['wrapped'],
+                                blocks[-1]['wrapped'])
+
+
+    def test_rewrap_fence(self):
+        txt = 'Para one.\n\n```\nnot fenced\n\nPara two.\n'
+        blocks = self.md.wrap_blocks(txt)
+
+        new_txt, new_blocks = self.md.rewrap(txt, blocks, len(txt),
+                                             len(txt), '```\n')
+        nose_tools.assert_equal(self.md.join_blocks(new_blocks),
+                                self.md(new_txt))
+
+    def test_parse_widths(self):
+        txt = _get_data('renderer-lists.md')
+        widths = [40, 60, 80]
+
+        nose_tools.assert_equal(self.md.parse_widths(txt, widths),
+                                [TWMarkdown(tw_width=w)(txt) for w in widths])
+
+        # The document is lexed once.
+        stats = TWStats()
+        TWMarkdown(tw_stats=stats).parse_widths(txt, widths)
+        timings = stats.as_dict()
+        nose_tools.assert_equal(timings['parse_list_block']['calls'],
+                                len([t for t in TWBlockLexer().parse(txt)
+                                     if t['type'] == 'list_start']))
+        nose_tools.assert_equal(
+            timings['output_list']['calls'],
+            len(widths) * timings['parse_list_block']['calls'])
+
+    def test_stats(self):
+        txt = _get_data('renderer-lists.md')
+        stats = TWStats()
+        md = TWMarkdown(tw_stats=stats)
+
+        nose_tools.assert_equal(md(txt), self.md(txt))
+
+        timings = stats.as_dict()
+        tokens = TWBlockLexer().parse(txt)
+        nose_tools.assert_equal(
+            timings['output_list']['calls'],
+            len([t for t in tokens if t['type'] == 'list_start'])
+        )
+        nose_tools.assert_equal(timings['tw_fill']['calls'],
+                                md.renderer.tw_cache_info().hits
+                                + md.renderer.tw_cache_info().misses)
+        assert timings['parse_list_block']['calls'] > 0
+        for t in timings.values():
+            assert 0 <= t['self_seconds'] <= t['seconds']
+
+        # Instances without stats are not instrumented.
+        nose_tools.assert_equal(self.md.stats, None)
+        assert 'output_list' not in vars(self.md)
+
+    def test_threads(self):
+        txts = [_get_data(f) for f in ['renderer-paragraphs.md',
+                                        'renderer-block-quote.md',
+                                        'renderer-lists.md',
+                                        'renderer-footnotes.md']] * 4
+        md = TWMarkdown(tw_width=40)
+
+        with ThreadPoolExecutor(4) as executor:
+            wrapped = list(executor.map(md, txts))
+        nose_tools.assert_equal(wrapped,
+                                [TWMarkdown(tw_width=40)(t) for t in txts])
+
+    def test_footnote_in_block_quote(self):
+        # Blocks after the footnote keep the block quote's prefix.
+        txt = '> A quote.\n[^1]: A note.\nMore of the quote.\n'
+        nose_tools.assert_equal(self.md(txt).splitlines()[-1],
+                                '> More of the quote.')
+
     def teardown(self):
         pass
+
+
+class TestWrapFiles(object):
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='md-tw-tests-')
+        self.files = ['renderer-paragraphs.md', 'renderer-lists.md',
+                      'renderer-block-quote.md']
+
+        os.mkdir(os.path.join(self.tmp_dir, 'docs'))
+        for f in self.files:
+            path = os.path.join(self.tmp_dir, 'docs', f)
+            with open(path, 'w') as f_:
+                f_.write(_get_data(f))
+
+    def _paths(self):
+        return [os.path.join(self.tmp_dir, 'docs', f) for f in self.files]
+
+    def test_wrap_files_in_order(self):
+        md = TWMarkdown()
+        paths = self._paths()
+        missing = os.path.join(self.tmp_dir, 'missing.md')
+
+        for jobs in [1, 2]:
+            docs = list(wrap_files(paths + [missing], jobs=jobs))
+
+            nose_tools.assert_equal([d[0] for d in docs], paths + [missing])
+            for path, (p, text, error) in zip(paths, docs):
+                nose_tools.assert_equal(error, None)
+                with open(path) as f:
+                    nose_tools.assert_equal(text, md(f.read()))
+
+            # Error of missing file is reported, not raised.
+            nose_tools.assert_equal(docs[-1][1], None)
+            nose_tools.assert_equal(docs[-1][2], 'No such file or directory')
+
+    def test_wrap_files_directory(self):
+        docs = list(wrap_files([self.tmp_dir], jobs=2, tw_width=40))
+
+        nose_tools.assert_equal([d[0] for d in docs], sorted(self._paths()))
+        for path, text, error in docs:
+            with open(path) as f:
+                nose_tools.assert_equal(text,
+                                        TWMarkdown(tw_width=40)(f.read()))
+
+    def test_mmap_lines(self):
+        for path in self._paths():
+            with open(path) as f:
+                lines = f.readlines()
+
+            for window in [1, 7, 64, 1 << 20]:
+                nose_tools.assert_equal(list(mmap_lines(path, window)),
+                                        lines)
+
+        empty = os.path.join(self.tmp_dir, 'empty.md')
+        open(empty, 'w').close()
+        nose_tools.assert_equal(list(mmap_lines(empty)), [])
+
+        nose_tools.assert_raises(FileNotFoundError, mmap_lines,
+                                 os.path.join(self.tmp_dir, 'missing.md'))
+
+    def test_wrap_files_mmap(self):
+        paths = self._paths()
+
+        docs = list(wrap_files(paths, jobs=2, use_mmap=True))
+        nose_tools.assert_equal(docs, list(wrap_files(paths, jobs=2)))
+
+    def test_wrap_files_stats(self):
+        calls = []
+        for jobs in [1, 2]:
+            stats = TWStats()
+            list(wrap_files(self._paths(), jobs=jobs, stats=stats))
+
+            timings = stats.as_dict()
+            assert timings['tw_fill']['calls'] > 0
+            calls.append(dict((k, t['calls']) for k, t in timings.items()))
+
+        # Timings of all workers are merged.
+        nose_tools.assert_equal(calls[0], calls[1])
+
+    def test_token_cache(self):
+        cache = TWTokenCache(os.path.join(self.tmp_dir, 'cache', 'tokens'))
+        files = ['renderer-lists.md', 'renderer-footnotes.md',
+                 'renderer-fences.md', 'renderer-block-html.md']
+
+        for f in files:
+            txt = _get_data(f)
+            nose_tools.assert_equal(TWMarkdown(tw_token_cache=cache)(txt),
+                                    TWMarkdown()(txt))
+
+            # Documents lexed before are not lexed again, at any width.
+            stats = TWStats()
+            md = TWMarkdown(tw_width=40, tw_token_cache=cache,
+                            tw_stats=stats)
+            nose_tools.assert_equal(md(txt), TWMarkdown(tw_width=40)(txt))
+            nose_tools.assert_equal(
+                [n for n in stats.as_dict() if n.startswith('parse_')], [])
+            nose_tools.assert_equal(
+                md.parse_widths(txt, [50, 60]),
+                [TWMarkdown(tw_width=w)(txt) for w in [50, 60]])
+
+        # Files that can't be read are lexed again.
+        txt = _get_data('renderer-lists.md')
+        path = cache._path(TWTokenCache.key([txt]))
+        assert os.path.exists(path)
+        with open(path, 'wb') as f:
+            f.write(b'junk')
+        nose_tools.assert_equal(cache.load(TWTokenCache.key([txt])), None)
+        nose_tools.assert_equal(TWMarkdown(tw_token_cache=cache)(txt),
+                                TWMarkdown()(txt))
+
+    def test_rewrite_files(self):
+        paths = self._paths()
+        cache = TWCache(os.path.join(self.tmp_dir, 'cache', 'wrapped'))
+
+        # Pretend the first document is wrapped already.
+        with open(paths[0]) as f:
+            unwrapped = f.read()
+        cache.add(TWCache.key(unwrapped, {}))
+        os.chmod(paths[1], 0o640)
+
+        docs = list(rewrite_files(paths, jobs=2, cache=cache))
+        nose_tools.assert_equal(docs, [(paths[0], False, None),
+                                       (paths[1], True, None),
+                                       (paths[2], True, None)])
+
+        # Documents keep their mode, and no other file is left.
+        nose_tools.assert_equal(os.stat(paths[1]).st_mode & 0o777, 0o640)
+        nose_tools.assert_equal(sorted(os.listdir(os.path.dirname(paths[0]))),
+                                sorted(self.files))
+
+        with open(paths[0]) as f:
+            nose_tools.assert_equal(f.read(), unwrapped)
+        for path, f in zip(paths[1:], self.files[1:]):
+            with open(path) as f_:
+                nose_tools.assert_equal(f_.read(), TWMarkdown()(_get_data(f)))
+
+        # Wrapped documents are remembered once they are found to be
+        # wrapped.
+        list(rewrite_files(paths, cache=cache))
+        cache = TWCache(cache.path)
+        for path in paths[1:]:
+            with open(path) as f:
+                assert TWCache.key(f.read(), {}) in cache
+
+    def _main(self, *args, cwd=None):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        return subprocess.run([sys.executable, '-c',
+                               'import sys, md_tw; sys.exit(md_tw.main())']
+                              + list(args), cwd=cwd, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def test_main_modes(self):
+        # Modes picked by the first argument are listed in --help.
+        p = self._main('--help')
+        for mode in ['md-tw bench', 'md-tw --daemon', 'md-tw --client']:
+            assert mode in p.stdout, mode
+
+        # A file named like a mode can still be wrapped.
+        with open(os.path.join(self.tmp_dir, 'bench'), 'w') as f:
+            f.write(_get_data(self.files[0]))
+        for args in [['./bench'], ['--', 'bench']]:
+            p = self._main(*args, cwd=self.tmp_dir)
+            nose_tools.assert_equal(p.returncode, 0)
+            nose_tools.assert_equal(p.stdout,
+                                    TWMarkdown()(_get_data(self.files[0]))
+                                    + '\n')
+
+    def test_main_errors(self):
+        paths = self._paths()
+        missing = os.path.join(self.tmp_dir, 'missing.md')
+
+        # A file that can't be read doesn't stop the files after it
+        # from being wrapped.
+        for jobs in ['1', '2']:
+            p = self._main('-j', jobs, paths[0], missing, paths[1])
+            nose_tools.assert_equal(p.returncode, 1)
+            nose_tools.assert_equal(p.stdout, ''.join(
+                TWMarkdown()(_get_data(f)) + '\n' for f in self.files[:2]))
+            nose_tools.assert_equal(
+                p.stderr,
+                'md-tw: {}: No such file or directory\n'.format(missing))
+
+    def test_main_in_place(self):
+        paths = self._paths()
+
+        # -i is not ignored with --check or --diff; they are refused.
+        for arg in ['--check', '--diff']:
+            p = self._main('-i', arg, '--no-cache', paths[1])
+            nose_tools.assert_equal(p.returncode, 2)
+            assert '--in-place' in p.stderr, p.stderr
+            with open(paths[1]) as f:
+                nose_tools.assert_equal(f.read(), _get_data(self.files[1]))
+
+    def test_diff_files(self):
+        paths = self._paths()
+        with open(paths[1], 'w') as f:
+            f.write(TWMarkdown()(_get_data(self.files[1])))
+
+        for jobs in [1, 2]:
+            docs = list(diff_files(paths, jobs))
+
+            nose_tools.assert_equal([d[0] for d in docs], paths)
+            nose_tools.assert_equal([bool(d[1]) for d in docs],
+                                    [True, False, True])
+            assert docs[0][1].startswith('--- {}\n'.format(paths[0]))
+
+    def test_write_wrapped_files(self):
+        paths = self._paths()
+        template = os.path.join(self.tmp_dir, 'out', '{width}',
+                                '{stem}{ext}')
+        missing = os.path.join(self.tmp_dir, 'missing.md')
+
+        docs = list(write_wrapped_files(paths + [missing], [40, 66],
+                                        template, jobs=2))
+
+        nose_tools.assert_equal([d[0] for d in docs], paths + [missing])
+        for (path, out_paths, error), f in zip(docs, self.files):
+            nose_tools.assert_equal(error, None)
+            nose_tools.assert_equal(
+                out_paths,
+                [os.path.join(self.tmp_dir, 'out', w, f) for w in ['40', '66']])
+            for out_path, width in zip(out_paths, [40, 66]):
+                with open(out_path) as f_:
+                    nose_tools.assert_equal(
+                        f_.read(), TWMarkdown(tw_width=width)(_get_data(f)))
+
+        nose_tools.assert_equal(docs[-1][1:],
+                                (None, 'No such file or directory'))
+
+    def test_check_files(self):
+        paths = self._paths()
+        cache = TWCache(os.path.join(self.tmp_dir, 'cache', 'wrapped'))
+        missing = os.path.join(self.tmp_dir, 'missing.md')
+
+        with open(paths[1], 'w') as f:
+            f.write(TWMarkdown()(_get_data(self.files[1])))
+
+        for jobs in [1, 2]:
+            docs = list(check_files(paths + [missing], jobs, cache))
+
+            nose_tools.assert_equal(docs[:3], [(paths[0], False, None),
+                                               (paths[1], True, None),
+                                               (paths[2], False, None)])
+            nose_tools.assert_equal(docs[3][:2], (missing, None))
+            assert docs[3][2]
+
+        # Wrapped documents are remembered.
+        with open(paths[1]) as f:
+            assert TWCache.key(f.read(), {}) in TWCache(cache.path)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
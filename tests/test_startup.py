@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+#   Copyright © 2018 rsiddharth <s@ricketyspace.net>.
+#
+#    This file is part of markdown-textwrap.
+#
+#   markdown-textwrap is free software: you can redistribute it
+#   and/or modify it under the terms of the GNU General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+#
+#   markdown-textwrap is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied
+#   warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#   See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with markdown-textwrap (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from nose import tools as nose_tools
+
+
+# Budgets, in seconds, for importing md_tw with the modules it imports,
+# mistune included, and for md-tw to wrap a one line document, on top
+# of the start up of a Python that does nothing.  They are about 1.5
+# times what they take with byte code cached (25 ms and 35 ms), so
+# that a regression fails them; a module that is imported eagerly
+# again is caught by test_lazy_imports too, a pattern compiled eagerly
+# by test_lazy_patterns.
+IMPORT_BUDGET = 0.04
+STARTUP_BUDGET = 0.055
+
+# Modules md_tw imports only when they are needed.
+LAZY_MODULES = ['argparse', 'difflib', 'hashlib', 'json', 'locale', 'mmap',
+                'multiprocessing', 'numpy']
+
+
+class TestStartup(object):
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='md-tw-tests-')
+
+        # Byte code is cached, as it is for an installed md-tw.
+        self.env = dict(os.environ, PYTHONPYCACHEPREFIX=self.tmp_dir)
+        self.env.pop('PYTHONDONTWRITEBYTECODE', None)
+        self._python('-c', 'import md_tw')
+
+    def _python(self, *args):
+        return subprocess.run([sys.executable] + list(args), env=self.env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, check=True)
+
+    def test_lazy_imports(self):
+        p = self._python('-c', 'import sys, md_tw; print(*sys.modules)')
+        modules = set(p.stdout.split())
+
+        for module in LAZY_MODULES:
+            assert module not in modules, module
+
+    def test_client_imports(self):
+        from markdown_textwrap import daemon
+
+        path = os.path.join(self.tmp_dir, 'md-tw.sock')
+        server = daemon.TWDaemon(path, idle_timeout=0.5)
+        thread = threading.Thread(target=server.serve)
+        thread.start()
+        try:
+            # md-tw-client leaves mistune and md_tw to the daemon.
+            p = subprocess.run(
+                [sys.executable, '-c',
+                 'import sys\n'
+                 'from markdown_textwrap import daemon\n'
+                 'status = daemon.client_main()\n'
+                 'print(*sys.modules, file=sys.stderr)\n'
+                 'sys.exit(status)',
+                 '--socket', path],
+                input='Lorem ipsum dolor sit amet.\n', env=self.env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, check=True)
+        finally:
+            thread.join(5)
+
+        nose_tools.assert_equal(p.stdout, 'Lorem ipsum dolor sit amet.\n\n')
+        modules = set(p.stderr.split())
+        for module in ['mistune', 'md_tw']:
+            assert module not in modules, module
+
+    def test_lazy_patterns(self):
+        # Patterns are compiled when they are first used, not when
+        # md_tw is imported.
+        p = self._python('-c', 'import re, bisect, textwrap, threading, '
+                               'mistune\n'
+                               'compiled = []\n'
+                               'compile = re.compile\n'
+                               'def count(*args, **kwargs):\n'
+                               '    compiled.append(args)\n'
+                               '    return compile(*args, **kwargs)\n'
+                               're.compile = count\n'
+                               'import md_tw\n'
+                               'print(compiled)')
+
+        nose_tools.assert_equal(p.stdout, '[]\n')
+
+    def test_import_time(self):
+        # -X importtime lines are 'import time: self | cumulative |
+        # name', in microseconds.
+        best = None
+        for i in range(3):
+            p = self._python('-X', 'importtime', '-c', 'import md_tw')
+            m = re.search(r'^import time: +\d+ \| +(\d+) \| md_tw$',
+                          p.stderr, flags=re.M)
+            assert m, p.stderr
+
+            elapsed = int(m.group(1)) / 1e6
+            if best is None or elapsed < best:
+                best = elapsed
+
+        assert best < IMPORT_BUDGET, best
+
+    def _best_time(self, *args):
+        best = None
+        for i in range(3):
+            start = time.perf_counter()
+            p = self._python(*args)
+            elapsed = time.perf_counter() - start
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return best, p
+
+    def test_startup_time(self):
+        path = os.path.join(self.tmp_dir, 'doc.md')
+        with open(path, 'w') as f:
+            f.write('Lorem ipsum dolor sit amet.\n')
+
+        python, p = self._best_time('-c', 'pass')
+        md_tw, p = self._best_time(
+            '-c', 'import sys, md_tw; sys.exit(md_tw.main())', path)
+        nose_tools.assert_equal(p.stdout, 'Lorem ipsum dolor sit amet.\n\n')
+
+        assert md_tw - python < STARTUP_BUDGET, (md_tw, python)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)